@@ -0,0 +1,206 @@
+"""Background agent of the Drastic command line interface.
+
+``drastic init --agent`` leaves a process running that keeps the
+authenticated DrasticClient of the session, and its pool of keep-alive
+connections, behind a Unix socket next to the session file.  The simple
+commands (see :data:`FORWARDED`) are then sent to it instead of being run in
+a fresh interpreter, which saves the imports, the session unpickling and the
+connection handshakes of every call.  Without an agent, or when it cannot be
+reached, commands run in-process as before.
+
+The protocol is one JSON line each way per connection::
+
+    {"argv": ["put", "f", "/c/f"], "cwd": "/home/me"}
+    {"out": "/c/f\\n", "err": "", "code": 0}
+
+The agent runs one command at a time, in the working directory of the
+caller, so relative local paths mean what they would in-process.  When the
+session file changes (a ``cd`` run in-process, by ``drastic batch`` say) the
+agent loads it again before the next command.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+import errno
+import json
+import os
+import socket
+import sys
+import time
+from SocketServer import StreamRequestHandler, UnixStreamServer
+
+
+SOCKET_NAME = 'agent.sock'
+# Commands that may be run by the agent, the others always run in-process
+# (they prompt, keep their own state or run for a long time)
+FORWARDED = ('cd', 'cdmi', 'chmod', 'get', 'ls', 'meta', 'mkdir', 'put',
+             'pwd', 'rm', 'whoami')
+# Options that ask for a client of their own
+LOCAL_OPTIONS = ('--url', '--trace', '--pool-size', '--debug')
+# Seconds to wait for a new agent to listen
+START_TIMEOUT = 5.0
+
+
+def socket_path(app):
+    """Path of the socket of the agent of an application's session."""
+    return os.path.join(os.path.dirname(app.session_path), SOCKET_NAME)
+
+
+def forwardable(arguments):
+    """Whether the command parsed by docopt can be run by the agent."""
+    if any(arguments.get(opt) for opt in LOCAL_OPTIONS):
+        return False
+    return any(arguments.get(cmd) for cmd in FORWARDED)
+
+
+def _call(path, request):
+    """Send a request to the agent, return its answer or None if there is
+    no agent listening."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+            raise
+        fp = sock.makefile('rwb')
+        fp.write(json.dumps(request) + '\n')
+        fp.flush()
+        line = fp.readline()
+        return json.loads(line) if line else None
+    finally:
+        sock.close()
+
+
+def forward(app, argv):
+    """Run a command in the agent and write its output.
+
+    :arg argv: the command line, without the program name
+    :returns: the exit code of the command, None if there is no agent
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        res = _call(socket_path(app), {'argv': argv, 'cwd': os.getcwd()})
+    except (socket.error, ValueError):
+        return None
+    if res is None:
+        return None
+    sys.stdout.write(res.get('out', u'').encode('utf-8'))
+    sys.stderr.write(res.get('err', u'').encode('utf-8'))
+    return res.get('code')
+
+
+def stop(app):
+    """Stop the agent of the session, if there is one.
+
+    :returns: True if an agent was running
+    """
+    path = socket_path(app)
+    try:
+        stopped = _call(path, {'argv': ['exit']}) is not None
+    except (socket.error, ValueError):
+        stopped = False
+    if not stopped and os.path.exists(path):
+        # Left behind by an agent that did not exit cleanly
+        os.remove(path)
+    return stopped
+
+
+def start(app, client):
+    """Start an agent holding ``client`` in the background.
+
+    Any agent of the session is replaced.  The agent detaches from the
+    terminal, it runs until ``drastic exit`` (or another ``init``).
+
+    :returns: True once the agent is listening
+    """
+    stop(app)
+    path = socket_path(app)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            serve(app, client, path)
+        finally:
+            os._exit(0)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if os.path.exists(path):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class AgentHandler(StreamRequestHandler):
+    """Run the command of one request."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        argv = request.get('argv') or []
+        if argv[:1] == ['exit']:
+            self.server.stopped = True
+            res = {'out': u'', 'err': u'', 'code': 0}
+        else:
+            res = self.server.run(argv, request.get('cwd') or '/')
+        self.wfile.write(json.dumps(res) + '\n')
+
+
+class AgentServer(UnixStreamServer):
+    """The agent, it serves requests one at a time until told to exit."""
+
+    def __init__(self, app, client, path):
+        app.client = client
+        self.app = app
+        self.stopped = False
+        self.loaded = self.session_mtime()
+        if os.path.exists(path):
+            os.remove(path)
+        # Only the user may talk to a process that holds their credentials
+        umask = os.umask(0o077)
+        try:
+            UnixStreamServer.__init__(self, path, AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def session_mtime(self):
+        """Modification time of the session file, None if there is none."""
+        try:
+            return os.stat(self.app.session_path).st_mtime
+        except OSError:
+            return None
+
+    def run(self, argv, cwd):
+        """Run a command line as ``drastic`` would, capturing its output."""
+        from cli import batch
+        try:
+            os.chdir(cwd)
+        except OSError as e:
+            return {'out': u'', 'err': u'{0}\n'.format(e), 'code': 1}
+        mtime = self.session_mtime()
+        if mtime != self.loaded:
+            # Saved by a command run in-process, the client held is stale
+            self.app.client = self.app.load_client()
+        code, out, err = batch.run(self.app, argv)
+        # Commands of the agent (cd) save the session they changed
+        self.loaded = self.session_mtime()
+        return {'out': out, 'err': err, 'code': code}
+
+
+def serve(app, client, path):
+    """Serve requests on the socket at ``path`` until an ``exit``."""
+    server = AgentServer(app, client, path)
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
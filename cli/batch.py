@@ -0,0 +1,212 @@
+"""Many commands in one process: ``drastic batch``.
+
+Each line of the input is a command line, as it would be given to
+``drastic`` (parsed with shell quoting rules), or a JSON list of its
+arguments, or a JSON object with an ``argv`` list.  Blank lines and lines
+starting with ``#`` are skipped.
+
+The commands share one DrasticClient, and its pool of connections.  The
+simple ones (see :func:`concurrent`) run on a pool of ``jobs`` threads,
+the others (``cd``, ``init``, ``mput`` ...) wait for the commands before
+them to end and run alone, so a ``cd`` applies to the lines after it.
+A command on the same path as one still running waits for it as well, so
+``meta set`` then ``meta ls`` of an object see each other.
+
+The output of every line is printed, in the order of the input, followed
+by a status line::
+
+    [12] exit 0: meta set /c/f color blue
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+import json
+import os
+import shlex
+import sys
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+
+# Results kept waiting for an earlier, slower, line, per job
+BACKLOG = 4
+
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+class ThreadOutput(object):
+    """A stand-in for sys.stdout or sys.stderr that writes to a buffer of
+    the current thread while it is capturing, to the real stream otherwise."""
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def write(self, s):
+        buf = getattr(_local, self.name, None)
+        (buf if buf is not None else self.stream).write(s)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+@contextmanager
+def captured():
+    """Capture what the current thread prints.
+
+    :returns: ( out , err ) the StringIO buffers of stdout and stderr
+    """
+    with _install_lock:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout, 'out')
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr, 'err')
+    _local.out, _local.err = StringIO(), StringIO()
+    try:
+        yield _local.out, _local.err
+    finally:
+        _local.out = _local.err = None
+
+
+def _text(s):
+    return s.decode('utf-8', 'replace') if isinstance(s, str) else s
+
+
+def run(app, argv, capture=True):
+    """Run one command line as ``drastic`` would.
+
+    :arg argv: the arguments, without the program name
+    :arg capture: capture its output rather than let it through
+    :returns: ( exit code , out , err ), out and err are empty when not
+      captured
+    """
+    from docopt import docopt
+    from cli.drastic import __doc_opt__, dispatch
+    out, err = StringIO(), StringIO()
+    with (captured() if capture else _passthrough()) as bufs:
+        try:
+            code = dispatch(app, docopt(__doc_opt__, argv))
+        except SystemExit as e:
+            # sys.exit() of a command, or a usage error from docopt
+            if isinstance(e.code, basestring):
+                sys.stderr.write(e.code + '\n')
+                code = 1
+            else:
+                code = e.code
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+            code = 1
+        if capture:
+            out, err = bufs
+    return code or 0, _text(out.getvalue()), _text(err.getvalue())
+
+
+@contextmanager
+def _passthrough():
+    yield None
+
+
+def parse(line):
+    """The arguments of a line of a batch, None for a blank line or a
+    comment."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line[0] in '[{':
+        argv = json.loads(line)
+        if isinstance(argv, dict):
+            argv = argv['argv']
+        return [a.encode('utf-8') if isinstance(a, unicode) else a
+                for a in argv]
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return shlex.split(line)
+
+
+def concurrent(arguments):
+    """Whether a command may run at the same time as others: the simple
+    ones the agent would run, but for ``cd``."""
+    from cli import agent
+    return agent.forwardable(arguments) and not arguments.get('cd')
+
+
+def _target(arguments):
+    """The path in the archive a simple command works on."""
+    if arguments.get('put'):
+        return arguments.get('<dest>') or os.path.basename(arguments['<src>'])
+    if arguments.get('get'):
+        return arguments['<src>']
+    return arguments.get('<path>')
+
+
+def run_batch(app, lines, jobs):
+    """Run the command lines of a batch.
+
+    :arg lines: iterable of lines
+    :arg jobs: number of commands run at the same time
+    :returns: number of lines that failed
+    """
+    from docopt import docopt
+    from cli.drastic import __doc_opt__
+    pool = ThreadPool(jobs)
+    pending = deque()       # ( path , result ) of the lines not reported yet
+    failed = [0]
+
+    def report(lineno, line, code, out, err):
+        sys.stdout.write(out.encode('utf-8'))
+        sys.stderr.write(err.encode('utf-8'))
+        print(u"[{0}] exit {1}: {2}".format(lineno, code, line.strip()))
+        sys.stdout.flush()
+        if code:
+            failed[0] += 1
+
+    def job(lineno, line, argv):
+        return (lineno, line) + run(app, argv)
+
+    def drain(keep=0):
+        while len(pending) > keep:
+            report(*pending.popleft()[1].get())
+
+    try:
+        for lineno, line in enumerate(lines, 1):
+            line = _text(line)
+            try:
+                argv = parse(line)
+                if argv is None:
+                    continue
+                arguments = docopt(__doc_opt__, argv)
+            except SystemExit:
+                # docopt did not recognise it
+                drain()
+                report(lineno, line, 1, u'', u"not a drastic command, see drastic --help\n")
+                continue
+            except (ValueError, KeyError) as e:
+                drain()
+                report(lineno, line, 1, u'', u"{0}\n".format(e))
+                continue
+            if arguments.get('batch'):
+                drain()
+                report(lineno, line, 1, u'', u"batch cannot be nested\n")
+            elif concurrent(arguments):
+                path = _target(arguments)
+                if path is not None and any(p == path for p, _ in pending):
+                    drain()
+                pending.append((path, pool.apply_async(job, (lineno, line, argv))))
+                drain(jobs * BACKLOG)
+            else:
+                # Alone, and its output as it comes
+                drain()
+                code = run(app, argv, capture=False)[0]
+                report(lineno, line, code, u'', u'')
+                if arguments.get('init') or arguments.get('exit'):
+                    # Share the new session, if any, with the next lines
+                    app.client = app.load_client()
+        drain()
+    finally:
+        pool.close()
+    return failed[0]
@@ -2,42 +2,70 @@
 """
 
 
+import codecs
 import json
 import mimetypes
 import mmap
 import os
 import logging
+import threading
 from base64 import b64encode
+from collections import deque
+from io import BytesIO
+from json.decoder import scanstring
 try:
     from urllib import pathname2url, url2pathname
 except ImportError:
     from urllib.request import pathname2url, url2pathname
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import cli
+from cli import trace
+from cli.errors import HTTPError
 
 
 __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 CDMI_CONTAINER = 'application/cdmi-container'
 CDMI_OBJECT = 'application/cdmi-object'
+# Default number of keep-alive connections kept open per host
+DEFAULT_POOL_SIZE = 10
+# Default number of ranges of a chunked upload sent at the same time
+CHUNK_WINDOW = 4
+# Default number of children asked for at once by ls_iter
+LS_PAGE_SIZE = 1000
+# Bytes of a listing read from the socket at once
+LS_READ_SIZE = 64 * 1024
+
+# Guards the lazy creation of the shared session
+_session_lock = threading.Lock()
 
 
 class Response(object):
     """A Response object returned by the client. It contains an error code and
     a JSON response. 0 or means the code executed correctly.
+
+    The body of a wrapped ``requests.Response`` is only decoded when json()
+    or msg() first needs it, a caller that checks ok() never pays for it.
+    ``convert``, if given, is applied to the JSON once it is decoded.
     """
 
-    def __init__(self, code, msg):
+    def __init__(self, code, msg, headers=None, convert=None):
         self._code = code
+        self._headers = headers or {}
+        self._raw = None
+        self._convert = convert
         if isinstance(msg, dict):
             self._json = msg
         elif isinstance(msg, requests.Response):
-            try:
-                self._json = msg.json()
-            except ValueError:
-                self._json = {"msg": msg.content}
+            # The body of a streamed response is read now, which gives its
+            # connection back to the pool, only decoding it is left for later
+            msg.content
+            self._headers = msg.headers
+            self._raw = msg
+            self._json = None
         else:
             self._json = {"msg": msg}
 
@@ -56,29 +84,139 @@ class Response(object):
         "msg" is used when we want to store string in the Response
         "detail" comes from Django errors (mainly 401/403)
         otherwise it's a full json response (CDMI for instance)"""
-        if "msg" in self._json:
-            return self._json["msg"]
-        elif "detail" in self._json:
-            return self._json["detail"]
+        body = self.json()
+        if "msg" in body:
+            return body["msg"]
+        elif "detail" in body:
+            return body["detail"]
         else:
-            return self._json
+            return body
 
     def json(self):
         """Return a full json message if we are sure we stored a json dict"""
+        if self._json is None:
+            try:
+                body = self._raw.json()
+            except ValueError:
+                body = {"msg": self._raw.content}
+            if self._convert:
+                body = self._convert(body)
+            # The raw response isn't needed any more
+            self._json, self._raw = body, None
         return self._json
 
+    def header(self, name, default=None):
+        """Return an HTTP header of the wrapped response (case insensitive)"""
+        return self._headers.get(name, default)
+
     def __str__(self):
-        return "({}, {})".format(self._code, self._json)
+        return "({}, {})".format(self._code, self.json())
+
+
+class CDMIValueStream(object):
+    """The body of a CDMI PUT of a data object with its metadata.
+
+    The JSON envelope is written around the content of ``data``, which is
+    base64 encoded block by block as the body is read, so memory use doesn't
+    depend on the size of the object. The length of the body is known in
+    advance, so it is sent with a Content-Length rather than chunked.
+    """
+
+    # A multiple of 3 so blocks encode without padding
+    blocksize = 3 * 64 * 1024
+
+    def __init__(self, metadata, data, mimetype):
+        """Create a new CDMI body.
+
+        :arg metadata: metadata for the object
+        :arg data: content for data object
+        :type data: byte string or file-like object
+        :arg mimetype: mimetype of data object
+
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if isinstance(data, str):
+            data = BytesIO(data)
+        self._data = data
+        # Size of what is left to be read from data
+        start = data.tell()
+        data.seek(0, os.SEEK_END)
+        size = data.tell() - start
+        data.seek(start)
+        envelope = {'metadata': metadata}
+        if size:
+            envelope.update({
+                'valuetransferencoding': "base64",
+                'mimetype': mimetype,
+            })
+        self.envelope = json.dumps(envelope)
+        if size:
+            self._head = self.envelope[:-1] + ', "value": "'
+            self._tail = '"}'
+            self._length = (len(self._head) + 4 * ((size + 2) // 3) +
+                            len(self._tail))
+        else:
+            self._head = self.envelope
+            self._tail = ''
+            self._length = len(self._head)
+        self._blocks = self._encode(bool(size))
+        self._block = ''
+        self._pos = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            block = self.read(self.blocksize)
+            if not block:
+                return
+            yield block
+
+    def _encode(self, has_value):
+        yield self._head
+        carry = ''
+        while has_value:
+            block = self._data.read(self.blocksize)
+            if not block:
+                break
+            block = carry + block
+            cut = len(block) - len(block) % 3
+            carry = block[cut:]
+            yield b64encode(block[:cut])
+        if carry:
+            yield b64encode(carry)
+        yield self._tail
+
+    def read(self, size=-1):
+        """Read at most ``size`` bytes of the body, all of it if negative"""
+        out = []
+        while size != 0:
+            if self._pos >= len(self._block):
+                self._block = next(self._blocks, None)
+                self._pos = 0
+                if self._block is None:
+                    self._block = ''
+                    break
+            end = len(self._block) if size < 0 else self._pos + size
+            piece = self._block[self._pos:end]
+            self._pos += len(piece)
+            if size > 0:
+                size -= len(piece)
+            out.append(piece)
+        return ''.join(out)
 
 
 class DrasticClient(object):
     """A client to an Drastic archive. Communicate with the archive through HTTP
     REST Api (CDMI for the archive and a simple one for admin operations)"""
 
-    def __init__(self, url):
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE):
         """Create a new instance of ``CDMIClient``.
 
         :arg url: base url of the Drastic archive ("http://127.0.0.1")
+        :arg pool_size: number of keep-alive connections kept per host
 
         """
         self.url = url
@@ -88,6 +226,92 @@ class DrasticClient(object):
         self._pwd = '/'
         self.auth = None
         self.u_agent = 'Drastic Client {0}'.format(cli.__version__)
+        self.pool_size = pool_size
+        self._session = None
+        self.tracer = None
+
+    def __getstate__(self):
+        # Open connections can't be saved with the client, a new pool is
+        # created on first use after unpickling. Neither can the tracer.
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['tracer'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Sessions saved by older versions may carry a stale 'session'
+        state.pop('session', None)
+        state.setdefault('pool_size', DEFAULT_POOL_SIZE)
+        state['_session'] = None
+        state['tracer'] = None
+        self.__dict__.update(state)
+
+    @property
+    def session(self):
+        """The ``requests.Session`` shared by every request of this client.
+
+        The session keeps up to ``pool_size`` keep-alive connections per host
+        and is safe to share between the mput worker threads.
+
+        """
+        if self._session is None:
+            with _session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    if self.tracer is None:
+                        adapter_cls = HTTPAdapter
+                    else:
+                        adapter_cls = trace.TracingAdapter
+                    adapter = adapter_cls(pool_connections=self.pool_size,
+                                          pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def set_pool_size(self, pool_size):
+        """Change the number of connections kept per host.
+
+        The existing pool is closed, the next request opens a new one.
+
+        :arg pool_size: number of keep-alive connections kept per host
+
+        """
+        pool_size = max(1, int(pool_size))
+        if pool_size == self.pool_size:
+            return
+        self.pool_size = pool_size
+        with _session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def set_tracer(self, tracer):
+        """Report every request of this client to ``tracer``.
+
+        ``tracer`` is called with one record (a dict) per request, see
+        :mod:`cli.trace` for its fields and for ready made sinks. Connections
+        are timed only while a tracer is set; with ``None`` requests go
+        straight to the session.
+
+        :arg tracer: callable, or None to stop tracing
+
+        """
+        if (tracer is None) == (self.tracer is None):
+            self.tracer = tracer
+            return
+        self.tracer = tracer
+        with _session_lock:
+            # The connection classes change, start a new pool
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _request(self, method, url, **kwargs):
+        """Send a request through the session, recording it if traced."""
+        if self.tracer is None:
+            return self.session.request(method, url, **kwargs)
+        return trace.traced(self.session, self.tracer, method, url, **kwargs)
 
     def authenticate(self, username, password):
         """Authenticate the client with ``username`` and ``password``.
@@ -104,9 +328,9 @@ class DrasticClient(object):
 
         """
         auth = (username, password)
-        res = requests.get(self.normalize_admin_url("authenticate"),
-                           headers={'user-agent': self.u_agent},
-                           auth=auth)
+        res = self._request('GET', self.normalize_admin_url("authenticate"),
+                            headers={'user-agent': self.u_agent},
+                            auth=auth)
         if res.status_code == 200:
             # authentication ok, keep authentication info for future use
             self.auth = auth
@@ -160,8 +384,8 @@ class DrasticClient(object):
                 "add_users": ls_user}
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url(u"groups/{}".format(groupname))
-        res = requests.put(req_url, headers=headers, auth=self.auth,
-                           data=json.dumps(data))
+        res = self._request('PUT', req_url, headers=headers, auth=self.auth,
+                            data=json.dumps(data))
         if res.status_code in [200, 201, 206]:
             return Response(0, res)
         else:
@@ -178,7 +402,7 @@ class DrasticClient(object):
         data = {"groupname": groupname}
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url("groups")
-        res = requests.post(req_url, headers=headers, auth=self.auth,
+        res = self._request('POST', req_url, headers=headers, auth=self.auth,
                             data=json.dumps(data))
         if res.status_code == 201:
             return Response(0, u"Group {} has been created".format(groupname))
@@ -202,7 +426,7 @@ class DrasticClient(object):
                 "administrator": is_admin}
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url("users")
-        res = requests.post(req_url, headers=headers, auth=self.auth,
+        res = self._request('POST', req_url, headers=headers, auth=self.auth,
                             data=json.dumps(data))
         if res.status_code == 201:
             return Response(0, u"User {} has been created".format(username))
@@ -222,7 +446,7 @@ class DrasticClient(object):
 
         """
         req_url = self.normalize_cdmi_url(path)
-        res = requests.delete(req_url, auth=self.auth)
+        res = self._request('DELETE', req_url, auth=self.auth)
         if res.status_code == 204:
             return Response(0, "ok")
         else:
@@ -238,7 +462,7 @@ class DrasticClient(object):
         """
         req_url = self.normalize_admin_url(path)
         headers = {'user-agent': self.u_agent}
-        res = requests.get(req_url, headers=headers, auth=self.auth)
+        res = self._request('GET', req_url, headers=headers, auth=self.auth)
         if res.status_code in [400, 401, 403, 404, 406]:
             return Response(res.status_code, res)
         try:
@@ -267,7 +491,7 @@ class DrasticClient(object):
             headers['Accept'] = CDMI_CONTAINER
         else:
             headers['Accept'] = CDMI_OBJECT
-        res = requests.get(req_url, headers=headers, auth=self.auth, allow_redirects=True)
+        res = self._request('GET', req_url, headers=headers, auth=self.auth, allow_redirects=True)
         if res.status_code in [400, 401, 403]:
             return Response(res.status_code,
                             res.content)
@@ -293,6 +517,129 @@ class DrasticClient(object):
             # It is probably not a CDMI API - this will be a problem!
             return Response(500, "Invalid response format")
 
+    def get_chunked(self, path, filename, size, chunk_size,
+                    window=CHUNK_WINDOW, done=(), progress=None):
+        """Download a data object into a local file one byte range at a time.
+
+        ``filename`` is sized to ``size`` bytes and ranges of ``chunk_size``
+        bytes are fetched with ``Range`` GETs, at most ``window`` of them at
+        the same time, each one written at its own offset in the file.
+
+        Ranges starting at an offset in ``done`` are not fetched again, which
+        resumes an interrupted download. ``progress`` is called with the
+        offset of each range once it is written.
+
+        If the archive ignores the ``Range`` header the whole object is
+        streamed into the file instead.
+
+        :arg path: path of the data object
+        :arg filename: local file to write
+        :arg size: size of the data object in bytes
+        :arg chunk_size: size of the ranges in bytes
+        :arg window: number of ranges fetched at the same time
+        :arg done: offsets of the ranges already written
+        :arg progress: callable, called with the offset of each written range
+        :returns: A Response object
+        :rtype: Response
+
+        """
+        logging.debug("DrasticClient.get_chunked called: \n{0}"
+                      .format(path))
+        mode = 'r+b' if os.path.isfile(filename) else 'wb'
+        with open(filename, mode) as fh:
+            fh.truncate(size)
+        pending = deque(start for start in xrange(0, size, chunk_size)
+                        if start not in done)
+        state = {'error': None}
+        state_lock = threading.Lock()
+
+        def fetch(fh, start):
+            end = min(start + chunk_size, size) - 1
+            res = self.open(path, start, end)
+            if res.status_code == 200 and start == 0:
+                # Range not supported, the whole object follows
+                end = size - 1
+            elif res.status_code != 206:
+                return Response(res.status_code, res)
+            fh.seek(start)
+            try:
+                for chunk in res.iter_content(64 * 1024):
+                    fh.write(chunk)
+            finally:
+                res.close()
+            if fh.tell() != end + 1:
+                return Response(500, u"Short read for bytes {0}-{1} of {2}"
+                                     "".format(start, end, path))
+            if res.status_code == 200:
+                pending.clear()
+            return Response(0, "ok")
+
+        def fetcher():
+            with open(filename, 'r+b') as fh:
+                while True:
+                    with state_lock:
+                        if state['error'] or not pending:
+                            return
+                        start = pending.popleft()
+                    res = fetch(fh, start)
+                    with state_lock:
+                        if not res.ok():
+                            state['error'] = state['error'] or res
+                            return
+                        if progress:
+                            progress(start)
+
+        if pending and pending[0] == 0:
+            # The first range tells whether the archive supports ranges
+            pending.popleft()
+            with open(filename, 'r+b') as fh:
+                res = fetch(fh, 0)
+            if not res.ok():
+                return res
+            if progress:
+                progress(0)
+        fetchers = [threading.Thread(target=fetcher)
+                    for _ in xrange(max(1, min(window, len(pending))))]
+        for t in fetchers:
+            t.setDaemon(True)
+            t.start()
+        for t in fetchers:
+            t.join()
+        if state['error']:
+            return state['error']
+        return Response(0, "ok")
+
+    def get_metadata(self, path):
+        """Return the metadata of a data object or container, without its
+        value or children.
+
+        Only the ``metadata`` field is asked for (``?metadata``), so this
+        costs the same for any size of object or container, ``cdmi_size``
+        says how large an object is.
+
+        :arg path: path of the data object, or of the container if it ends
+          with a '/'
+        :returns: CDMI JSON response, the metadata as a dict
+        :rtype: Response
+
+        """
+        req_url = self.normalize_cdmi_url(path) + '?metadata'
+        headers = {'user-agent': self.u_agent,
+                   'X-CDMI-Specification-Version': "1.1",
+                   'Accept': CDMI_CONTAINER if path.endswith('/')
+                   else CDMI_OBJECT}
+        res = self._request('GET', req_url, headers=headers, auth=self.auth,
+                            allow_redirects=True)
+        if res.status_code in [404, 406]:
+            return Response(res.status_code,
+                            u"Cannot access '{0}': No such object".format(path))
+        elif res.status_code >= 400:
+            return Response(res.status_code, res.content)
+        try:
+            return Response(0, res.json().get('metadata', {}))
+        except ValueError:
+            return Response(500, "Invalid response format")
+
     def list_group(self, groupname):
         """Get information about a group.
 
@@ -381,6 +728,62 @@ class DrasticClient(object):
             path = u"{}/".format(path)
         return self.get_cdmi(path)
 
+    def ls_iter(self, path, page_size=LS_PAGE_SIZE):
+        """Iterate over the children of a container, as they arrive.
+
+        The children are asked for ``page_size`` at a time
+        (``?children:<start>-<end>``) and each page is parsed as it is
+        read, so neither the listing nor a page is ever held whole.  A
+        server that ignores the range and sends all the children at once
+        is read to the end the same way.  Containers end with a '/'.
+
+        :arg path: path of the container, the current one if empty
+        :arg page_size: number of children per request
+        :returns: iterator of child names, in the server's order
+        :raises HTTPError: if the container cannot be listed
+        :raises ValueError: if ``page_size`` is less than 1
+
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1, not {0}"
+                             .format(page_size))
+        if not path:
+            path = self.pwd()
+        elif not path.endswith("/"):
+            path = u"{}/".format(path)
+        req_url = self.normalize_cdmi_url(path)
+        headers = {'user-agent': self.u_agent,
+                   'X-CDMI-Specification-Version': "1.1",
+                   'Accept': CDMI_CONTAINER}
+        start, previous = 0, None
+        while True:
+            url = "{0}?children:{1}-{2}".format(req_url, start,
+                                                start + page_size - 1)
+            res = self._request('GET', url, headers=headers, auth=self.auth,
+                                allow_redirects=True, stream=True)
+            count, first = 0, None
+            try:
+                if res.status_code in [404, 406]:
+                    raise HTTPError(res.status_code,
+                                    u"Cannot access '{0}': No such container"
+                                    "".format(path[:-1]))
+                elif res.status_code >= 400:
+                    raise HTTPError(res.status_code, res.content)
+                for child in iter_children(res.iter_content(LS_READ_SIZE)):
+                    if count == 0:
+                        if child == previous:
+                            # The same page again, the range was ignored
+                            return
+                        first = child
+                    count += 1
+                    yield child
+            finally:
+                res.close()
+            if count != page_size:
+                # The last page, or all the children at once
+                return
+            start, previous = start + page_size, first
+
     def mkdir(self, path):
         """Create a container.
 
@@ -417,8 +820,8 @@ class DrasticClient(object):
         """
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url(u"users/{}".format(username))
-        res = requests.put(req_url, headers=headers, auth=self.auth,
-                           data=json.dumps(data))
+        res = self._request('PUT', req_url, headers=headers, auth=self.auth,
+                            data=json.dumps(data))
         if res.status_code == 200:
             return Response(0, u"User {} has been modified".format(username))
         else:
@@ -444,6 +847,15 @@ class DrasticClient(object):
         :arg path: path relative to current path
         :returns: absolute CDMI URL
 
+        """
+        return self.cdmi_url + pathname2url(self.normalize_cdmi_path(path))
+
+    def normalize_cdmi_path(self, path):
+        """Normalize path relative to current path and return.
+
+        :arg path: path relative to current path
+        :returns: absolute path in the archive
+
         """
         # Turn URL path into OS path for manipulation
         mypath = url2pathname(path)
@@ -455,8 +867,7 @@ class DrasticClient(object):
             mypath += os.path.sep
         # if isinstance(mypath, str):
         #    mypath = mypath.encode('utf8')
-        url = self.cdmi_url + pathname2url(mypath)
-        return url
+        return mypath
 
     def put_cdmi(self, path, data):
         """Return JSON response for a PUT to a CDMI URL.
@@ -478,11 +889,8 @@ class DrasticClient(object):
         else:
             headers['Content-type'] = CDMI_OBJECT
             headers['Accept'] = CDMI_OBJECT
-        req = requests.Request('PUT', req_url, headers=headers, auth=self.auth,
-                               data=data)
-        prepared = req.prepare()
-        s = requests.Session()
-        res = s.send(prepared)
+        res = self._request('PUT', req_url, headers=headers, auth=self.auth,
+                            data=data)
         if res.status_code in [400, 401, 403, 404, 406]:
             return Response(res.status_code, res)
         elif res.status_code == 409:
@@ -490,12 +898,128 @@ class DrasticClient(object):
                             "A resource with this name already exists")
         return Response(0, res)
 
-    def put_http(self, path, data, content_type):
+    def put_chunked(self, path, fh, mimetype=None, chunk_size=None,
+                    window=CHUNK_WINDOW, offset=0, progress=None,
+                    verify=False, stamp=None):
+        """Create or update a large data object one byte range at a time.
+
+        The content of the file-like object ``fh`` is sent in ranges of
+        ``chunk_size`` bytes with ``Content-Range`` PUTs, at most ``window``
+        of them in flight at the same time. The first range is written on
+        its own so the object exists before the others are sent.
+
+        An interrupted transfer is resumed by passing the last ``offset`` and
+        ``stamp`` reported to ``progress``, which is called with the offset
+        below which every range has been acknowledged by the archive and the
+        ``(size, mtime)`` of the file being sent.  The transfer starts over
+        from the first byte when the file no longer has that size and mtime.
+
+        :arg path: path to create
+        :arg fh: file-like object opened for reading
+        :arg mimetype: mimetype of data object to create
+        :arg chunk_size: size of the ranges in bytes
+        :arg window: number of ranges sent at the same time
+        :arg offset: number of bytes already written by a previous attempt
+        :arg progress: callable, called with the acknowledged offset
+        :arg verify: read the object back from the archive once written
+        :arg stamp: ``(size, mtime)`` of the file when ``offset`` was reported
+        :returns: CDMI JSON response
+        :rtype: Response
+
+        """
+        logging.debug("DrasticClient.put_chunked called: \n{0} from {1}"
+                      .format(path, offset))
+        if not mimetype:
+            mimetype = guess_mimetype(path)
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        if not chunk_size or size <= chunk_size:
+            fh.seek(0)
+            return self.put(path, fh, mimetype, verify=verify)
+        current = file_stamp(fh)
+        if offset and tuple(stamp or ()) != current:
+            # The file changed since the ranges were acknowledged, or there
+            # is nothing to tell, the archive holds parts of another file
+            logging.debug("DrasticClient.put_chunked: {0} changed, restarting"
+                          .format(path))
+            offset = 0
+        if offset >= size:
+            # Everything has been acknowledged already, check that the object
+            # is there without reading its value back
+            if verify:
+                return self.get_cdmi(path)
+            return self.describe_object(path)
+
+        read_lock = threading.Lock()
+
+        def send(start):
+            with read_lock:
+                fh.seek(start)
+                chunk = fh.read(chunk_size)
+            content_range = 'bytes {0}-{1}/{2}'.format(start,
+                                                       start + len(chunk) - 1,
+                                                       size)
+            return self.put_http(path, chunk, mimetype,
+                                 {'Content-Range': content_range})
+
+        res = None
+        if offset == 0:
+            res = send(0)
+            if not res.ok():
+                return res
+            offset = chunk_size
+            if progress:
+                progress(offset, current)
+
+        pending = deque(xrange(offset, size, chunk_size))
+        state = {'done': offset, 'acked': set(), 'last': res, 'error': None}
+        state_lock = threading.Lock()
+
+        def sender():
+            while True:
+                with state_lock:
+                    if state['error'] or not pending:
+                        return
+                    start = pending.popleft()
+                res = send(start)
+                with state_lock:
+                    if not res.ok():
+                        state['error'] = state['error'] or res
+                        return
+                    state['last'] = res
+                    state['acked'].add(start)
+                    # Advance over the contiguous acknowledged ranges
+                    done = state['done']
+                    while done in state['acked']:
+                        state['acked'].discard(done)
+                        done = min(done + chunk_size, size)
+                    if done != state['done']:
+                        state['done'] = done
+                        if progress:
+                            progress(done, current)
+
+        senders = [threading.Thread(target=sender)
+                   for _ in xrange(max(1, min(window, len(pending))))]
+        for t in senders:
+            t.setDaemon(True)
+            t.start()
+        for t in senders:
+            t.join()
+        if state['error']:
+            return state['error']
+        if verify:
+            return self.get_cdmi(path)
+        if state['last'] is None:
+            return self.describe_object(path)
+        return self.put_response(path, state['last'])
+
+    def put_http(self, path, data, content_type, headers=None):
         """Return JSON response for a PUT to a CDMI URL.
 
         :arg path: path to put
         :arg data: str data to put
         :arg content_type: Content Type for the data
+        :arg headers: extra HTTP headers for the request (Content-Range, ...)
         :returns: text response
         :rtype: str
 
@@ -503,15 +1027,66 @@ class DrasticClient(object):
         logging.debug("DrasticClient.put_http called: \n{0} {1}"
                       .format(path, content_type))
         req_url = self.normalize_cdmi_url(path)
-        headers = {'user-agent': self.u_agent,
-                   'Content-type': content_type,
-                   'Accept': ','.join([CDMI_CONTAINER, CDMI_OBJECT, 'application/json'])}
-        res = requests.put(req_url, headers=headers, auth=self.auth,
-                           data=data)
-        if res.status_code in [400, 401, 403, 404, 406]:
+        headers = dict(headers or {})
+        headers.update({'user-agent': self.u_agent,
+                        'Content-type': content_type,
+                        'Accept': ','.join([CDMI_CONTAINER, CDMI_OBJECT, 'application/json'])})
+        res = self._request('PUT', req_url, headers=headers, auth=self.auth,
+                            data=data)
+        if res.status_code >= 400:
             return Response(res.status_code, res)
         return Response(0, res)
 
+    def put_response(self, path, res):
+        """Build the CDMI description of an object from the response of the
+        PUT that wrote it, without another round trip to the archive.
+
+        The CDMI body is used when the server sent one, otherwise the object
+        name and parent are derived from ``path`` and the ``Location`` and
+        ``ETag`` headers are kept.  The choice is made when the description
+        is first asked for, the body isn't parsed before then.
+
+        :arg path: path of the data object that was put
+        :arg res: Response of the PUT
+        :returns: CDMI JSON response
+        :rtype: Response
+
+        """
+        derived = self._object_names(path)
+        derived.update({'location': res.header('Location'),
+                        'etag': res.header('ETag')})
+
+        def describe(cdmi_info):
+            return cdmi_info if 'objectName' in cdmi_info else derived
+        if res._raw is None:
+            return Response(0, describe(res.json()), res._headers)
+        return Response(0, res._raw, convert=describe)
+
+    def describe_object(self, path):
+        """Build the CDMI description of a data object from its metadata
+        (see :meth:`get_metadata`), without a GET of its value.
+
+        :arg path: path of the data object
+        :returns: CDMI JSON response
+        :rtype: Response
+
+        """
+        res = self.get_metadata(path)
+        if not res.ok():
+            return res
+        cdmi_info = self._object_names(path)
+        cdmi_info['metadata'] = res.json()
+        return Response(0, cdmi_info)
+
+    def _object_names(self, path):
+        """The type, name and parent of the data object at ``path``."""
+        parent, name = os.path.split(self.normalize_cdmi_path(path))
+        if not parent.endswith('/'):
+            parent += '/'
+        return {'objectType': CDMI_OBJECT,
+                'objectName': name,
+                'parentURI': parent}
+
     def pwd(self):
         """Get and return path of current container.
 
@@ -531,7 +1106,7 @@ class DrasticClient(object):
         """
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url(u"groups/{}".format(groupname))
-        res = requests.delete(req_url, headers=headers, auth=self.auth)
+        res = self._request('DELETE', req_url, headers=headers, auth=self.auth)
         if res.status_code == 200:
             return Response(0, u"Group {} has been removed".format(groupname))
         else:
@@ -547,7 +1122,7 @@ class DrasticClient(object):
         """
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url(u"users/{}".format(username))
-        res = requests.delete(req_url, headers=headers, auth=self.auth)
+        res = self._request('DELETE', req_url, headers=headers, auth=self.auth)
         if res.status_code == 200:
             return Response(0, u"User {} has been removed".format(username))
         else:
@@ -566,8 +1141,8 @@ class DrasticClient(object):
                 "rm_users": ls_user}
         headers = {'user-agent': self.u_agent}
         req_url = self.normalize_admin_url(u"groups/{}".format(groupname))
-        res = requests.put(req_url, headers=headers, auth=self.auth,
-                           data=json.dumps(data))
+        res = self._request('PUT', req_url, headers=headers, auth=self.auth,
+                            data=json.dumps(data))
         if res.status_code in [200, 206]:
             return Response(0, res)
         else:
@@ -585,7 +1160,7 @@ class DrasticClient(object):
         else:
             return "Anonymous"
 
-    def open(self, path):
+    def open(self, path, start=None, end=None):
         """Open a URL in stream mode to avoid loading the whole content in
         memory.
 
@@ -594,16 +1169,22 @@ class DrasticClient(object):
         for chunk in res.iter_content(8192):
             # do domething with chunk
 
+        Only the bytes from ``start`` to ``end`` (included) are requested if
+        they are given.
+
         """
         req_url = self.normalize_cdmi_url(path)
         headers = {'user-agent': 'Drastic Client {0}'.format(cli.__version__),
                    'Accept': "application/octet-stream"}
-        return requests.get(req_url,
-                            headers=headers,
-                            auth=self.auth,
-                            stream=True)
-
-    def put(self, path, data='', mimetype=None, metadata={}):
+        if start is not None:
+            headers['Range'] = 'bytes={0}-{1}'.format(start,
+                                                      '' if end is None else end)
+        return self._request('GET', req_url,
+                             headers=headers,
+                             auth=self.auth,
+                             stream=True)
+
+    def put(self, path, data='', mimetype=None, metadata={}, verify=False):
         """Create or update a data object.
 
         Create or update the data object at ``path`` and return the CDMI
@@ -621,6 +1202,8 @@ class DrasticClient(object):
         :type data: dict (of CDMI JSON) byte string or file-like object
         :arg mimetype: mimetype of data object to create.
         :arg metadata: metadata for object
+        :arg verify: read the object back from the archive once written,
+                     otherwise the result is built from the PUT response
         :returns: CDMI JSON response
         :rtype: dict
 
@@ -629,59 +1212,136 @@ class DrasticClient(object):
                       .format(path))
         # Deal with missing mimetype
         if not mimetype:
-            type_, enc_ = mimetypes.guess_type(path)
-            if not type_:
-                mimetype = "application/octet-stream"
-            else:
-                if enc_ == 'gzip' and type_ == 'application/x-tar':
-                    mimetype = "application/x-gtar"
-                elif enc_ == 'gzip':
-                    mimetype = "application/x-gzip"
-                elif enc_ == 'bzip2' and type_ == 'application/x-tar':
-                    mimetype = "application/x-gtar"
-                elif enc_ == 'bzip2':
-                    mimetype = "application/x-bzip2"
-                else:
-                    mimetype = type_
+            mimetype = guess_mimetype(path)
         # Deal with varying data type
         if isinstance(data, dict):
             data = json.dumps(data)
-        elif not isinstance(data, (mmap.mmap, str)):
-            # Read the file-like object as a memory mapped string. Looks like
-            # a string, but accesses the file directly. This avoids reading
-            # large files into memory
-            try:
-                data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
-            except ValueError:
-                # Unable to memory map
-                # Simply read in file
-                data = data.read()
 
         if metadata:
             # PUT the data as a CDMI object
-            # Create the CDMI Data Object Structure
-            d = {'metadata': metadata}
-            if data:
-                d.update({
-                    'value': b64encode(data).decode('ascii'),
-                    'valuetransferencoding': "base64",
-                    'mimetype': mimetype,
-                })
-            data = json.dumps(d)
+            # Create the CDMI Data Object Structure, the value is base64
+            # encoded while the request is sent so the content is never held
+            # in memory
+            body = CDMIValueStream(metadata, data, mimetype)
             if 'size' in metadata and metadata['size'] == 0:
-                logging.warn('Sending Zero Length File:\n{0}'.format(data))
+                logging.warn('Sending Zero Length File:\n{0}'.format(body.envelope))
             # Add the metadata parameters into the URL
 #             p = ''.join(["metadata:{0};".format(k)
 #                          for k
 #                          in metadata])
             # req_url = req_url + '?' + p
-            return self.put_cdmi(path, data)
+            return self.put_cdmi(path, body)
         else:
+            if not isinstance(data, (mmap.mmap, str)):
+                # Read the file-like object as a memory mapped string. Looks
+                # like a string, but accesses the file directly. This avoids
+                # reading large files into memory
+                try:
+                    data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Unable to memory map
+                    # Simply read in file
+                    data = data.read()
             # PUT the data in non-CDMI to avoid unnecessary base64 overhead
             # req_url = self.normalize_cdmi_url(path)
-            self.put_http(path, data, mimetype)
-            # return self.get_cdmi(os.path.split(path)[0])
-            return self.get_cdmi(path)
+            res = self.put_http(path, data, mimetype)
+            if not res.ok():
+                return res
+            if verify:
+                return self.get_cdmi(path)
+            return self.put_response(path, res)
+
+
+def guess_mimetype(path):
+    """Guess the mimetype of a data object from its name.
+
+    :arg path: path or name of the data object
+    :returns: a mimetype, "application/octet-stream" if it can't be guessed
+    :rtype: str
+
+    """
+    type_, enc_ = mimetypes.guess_type(path)
+    if not type_:
+        return "application/octet-stream"
+    else:
+        if enc_ == 'gzip' and type_ == 'application/x-tar':
+            return "application/x-gtar"
+        elif enc_ == 'gzip':
+            return "application/x-gzip"
+        elif enc_ == 'bzip2' and type_ == 'application/x-tar':
+            return "application/x-gtar"
+        elif enc_ == 'bzip2':
+            return "application/x-bzip2"
+        else:
+            return type_
+
+
+def file_stamp(fh):
+    """The ``(size, mtime)`` of an open file, which tell whether the ranges
+    of it acknowledged by the archive may still be trusted."""
+    st = os.fstat(fh.fileno())
+    return (st.st_size, st.st_mtime)
+
+
+def iter_children(chunks):
+    """Yield the names of the top level ``children`` array of a CDMI JSON
+    object as its text arrives.
+
+    Only the string being read is buffered, the rest of the object
+    (metadata ...) is skipped over without being decoded.
+
+    :arg chunks: iterable of byte strings, the body of a response
+    :raises ValueError: if the body ends in the middle of a string
+
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, i = u'', 0
+    depth = 0
+    key = None              # the last key of the top level object
+    expect_key = False
+    in_children = False
+    need_more = False       # a string is cut by the end of the buffer
+    while True:
+        if need_more or i >= len(buf):
+            chunk = next(chunks, None)
+            if chunk is None:
+                if need_more:
+                    raise ValueError("Listing ends in the middle of a string")
+                return
+            buf, i = buf[i:] + decoder.decode(chunk), 0
+            need_more = False
+            continue
+        c = buf[i]
+        if c == '"':
+            try:
+                value, i = scanstring(buf, i + 1)
+            except ValueError:
+                need_more = True
+                continue
+            if in_children:
+                yield value
+            elif depth == 1 and expect_key:
+                key, expect_key = value, False
+            continue
+        i += 1
+        if in_children:
+            if c == ']':
+                return
+        elif c == '{':
+            depth += 1
+            expect_key = depth == 1
+        elif c == '[':
+            if depth == 1 and key == 'children':
+                in_children = True
+            else:
+                depth += 1
+        elif c in '}]':
+            depth -= 1
+            if depth == 0:
+                return
+        elif c == ',' and depth == 1:
+            expect_key = True
 
 
 def write_request(req):
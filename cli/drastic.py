@@ -4,23 +4,15 @@
 
 import errno
 import os
-import pickle
 import sys
-import logging
-from getpass import getpass
-from operator import methodcaller
-import json
 
-import requests
-from requests.exceptions import ConnectionError
 from docopt import docopt
 
 import cli
-from cli.acl import (
-    cdmi_str_to_str_acemask,
-    str_to_cdmi_str_acemask
-)
-from cli.client import DrasticClient
+from cli import agent
+
+# Each command imports what it needs (requests, the client, the mput and
+# mget packages ...), so that the simple ones start quickly
 
 __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
@@ -30,17 +22,19 @@ Drastic Command Line Interface.
 Usage:
   drastic (-h | --help)
   drastic --version
-  drastic init --url=<URL> [--username=<USER>] [--password=<PWD>]
+  drastic init --url=<URL> [--username=<USER>] [--password=<PWD>] [--agent]
+  drastic init --agent
   drastic whoami
   drastic exit
+  drastic batch [--jobs=<N>] [--trace=<file>] (<batch-file>|-)
   drastic pwd
-  drastic ls [<path>] [-a]
+  drastic ls [<path>] [-a] [--unsorted] [--page-size=<N>] [--trace=<file>]
   drastic cd [<path>]
-  drastic cdmi <path>
+  drastic cdmi <path> [--trace=<file>]
   drastic mkdir <path>
-  drastic put <src> [<dest>] [--mimetype=<MIME>]
+  drastic put <src> [<dest>] [--mimetype=<MIME>] [--verify] [--chunk-size=<N> [--window=<N>]] [--trace=<file>]
   drastic put --ref <url> <dest> [--mimetype=<MIME>]
-  drastic get <src> [<dest>] [--force]
+  drastic get <src> [<dest>] [--force | --resume] [--chunk-size=<N>] [--window=<N>] [--trace=<file>]
   drastic rm <path>
   drastic chmod <path> (read|write|null) <group>
   drastic meta add <path> <meta_name> <meta_value>
@@ -56,26 +50,56 @@ Usage:
   drastic admin rmgroup [<name>]
   drastic admin atg <name> <user> ...
   drastic admin rtg <name> <user> ...
-  drastic mput-prepare [-l label] (--walk <file-list> | --read (<source-dir>|-))
-  drastic mput-execute [-D <debug_level>] [-l label] <tgt-dir-in-repo>
-  drastic mput --walk <source-dir>     <tgt-dir-in-repo>
-  drastic mput --read (<file-list>|-)  <tgt-dir-in-repo>
+  drastic mput-prepare [-l label] [--sync [--checksum]] (--walk <source-dir> | --read (<file-list>|-))
+  drastic mput-execute [-D <debug_level>] [-l label] [--lease=<secs>] [--max-attempts=<N>] [--skip-existing [--size-only] [--cache-ttl=<secs>]] [--progress] [--metrics=<file> [--metrics-format=<fmt>]] [--trace=<file>] [--engine=<name> [--inflight=<N>]] [--min-threads=<N>] [--max-threads=<N>] [--pool-size=<N>] [--verify] [--chunk-size=<N> [--window=<N>]] <tgt-dir-in-repo>
+  drastic mput [--progress] [--metrics=<file> [--metrics-format=<fmt>]] [--trace=<file>] [--engine=<name> [--inflight=<N>]] [--pool-size=<N>] [--verify] [--chunk-size=<N> [--window=<N>]] --walk <source-dir>     <tgt-dir-in-repo>
+  drastic mput [--progress] [--metrics=<file> [--metrics-format=<fmt>]] [--trace=<file>] [--engine=<name> [--inflight=<N>]] [--pool-size=<N>] [--verify] [--chunk-size=<N> [--window=<N>]] --read (<file-list>|-)  <tgt-dir-in-repo>
   drastic mput-status [-l label] [--reset] [(--clear|--clean)]
+  drastic mget-prepare [-l label] <src-dir-in-repo>
+  drastic mget-execute [-D <debug_level>] [-l label] [--lease=<secs>] [--max-attempts=<N>] [--pool-size=<N>] [--trace=<file>] <local-dir>
+  drastic mget [--pool-size=<N>] [--trace=<file>] <src-dir-in-repo> <local-dir>
+  drastic mget-status [-l label] [--reset] [(--clear|--clean)]
 
 Options:
   -h --help     Show this screen.
   --version     Show version.
   --url=<URL>   Location of Indigo server
+  --agent       keep the session in a background process that runs the simple commands, until exit
+  --jobs=<N>    number of commands of a batch run at the same time [ default: 8 ]
+  --unsorted    list the children of a container as they arrive, page by page, in the server's order
+  --page-size=<N>   children asked for at once when listing a container page by page [ default: 1000 ]
   -l --label    a label to have multiple prepares and executes simultaneously  [ default: transfer ]
   --reset       reset all 'in-progress' entries to 'ready' in the work queue
   --clear       remove all the entries in the workqueue
   --clean       remove all the 'DONE' entries in the workqueue
+  --lease=<secs>    entries claimed by an executor that stops renewing them go back in the queue after this [ default: 3600, at least 240 ]
+  --max-attempts=<N>  failed entries are retried, with a growing delay, until they have failed N times [ default: 5 ]
+  --skip-existing   mark done, without sending them, the files already in the archive with the same size and md5
+  --size-only   with --skip-existing, also skip the files of the same size as an object the archive keeps no md5 for
+  --cache-ttl=<secs>  with --skip-existing, reuse the listings of the target containers kept in the queue for this long [ default: 86400 ]
   -D <debug_level>  trace/debug statements, integer >= 0  [ default: 0 ]
+  --pool-size=<N>   keep-alive connections kept per host [ default: number of worker threads ]
+  --verify      read each data object back from the archive after it is put
+  --engine=<name>   'threads' for a fixed pool of workers, 'async' to keep many PUTs in flight [ default: threads ]
+  --inflight=<N>    number of PUTs kept in flight by the async engine [ default: 256 ]
+  --min-threads=<N>  let the number of active workers adapt to latency and errors, no less than N [ default: 1 ]
+  --max-threads=<N>  let the number of active workers adapt to latency and errors, no more than N [ default: 32 ]
+  --chunk-size=<N>  transfer files larger than N bytes as ranges of N bytes, interrupted transfers resume
+  --window=<N>      number of ranges of one file transferred at the same time [ default: 4 ]
+  --resume      fetch only the ranges missing from an interrupted download
+  --progress    keep a line with the transfer rates and the ETA up to date on stderr
+  --metrics=<file>  every 10 seconds, record files/sec, bytes/sec, PUT and mkdir latency percentiles, retries and queue depth
+  --metrics-format=<fmt>  'json' appends JSON lines, 'prometheus' rewrites a textfile for node_exporter [ default: json ]
+  --trace=<file>    append a JSON line per HTTP request to file: status, bytes, connect / first byte / total time
+  --sync        queue only new files and files changed ( size or mtime ) since they were last sent
+  --checksum    with --sync, also compare the md5 of the files, reading every one of them
   --debug       show debug output on the command-line
 
 
 Arguments:
   <tgt-dir-in-repo>    where to place the files when you inject them [ default: / ]
+  <src-dir-in-repo>    the container tree to fetch
+  <local-dir>          where to place the fetched files, under their path in the repository
 
 
 
@@ -83,6 +107,10 @@ Arguments:
 
 
 SESSION_PATH = os.path.join(os.path.expanduser('~'), '.drastic',  'session.pickle')
+# Size of the ranges fetched in parallel by get
+GET_CHUNK_SIZE = 8 * 1024 * 1024
+# Commands of a batch run at the same time
+BATCH_JOBS = 8
 
 
 def unicode(string, foo):
@@ -94,6 +122,8 @@ class DrasticApplication(object):
 
     def __init__(self, session_path):
         self.session_path = session_path
+        # The client of the session, kept between commands by the agent
+        self.client = None
 
     def admin_atg(self, args):
         """Add user(s) to a group."""
@@ -200,6 +230,7 @@ class DrasticApplication(object):
 
     def admin_mkuser(self, args):
         """Create a new user. Ask in the terminal for mandatory fields"""
+        from getpass import getpass
         client = self.get_client(args)
         if not args['<name>']:
             username = raw_input("Please enter the user's username: ")
@@ -229,6 +260,7 @@ class DrasticApplication(object):
     def admin_moduser(self, args):
         """Moduser a new user. Ask in the terminal if the value isn't
         provided"""
+        from getpass import getpass
         client = self.get_client(args)
         value = args['<value>']
         name = args['<name>']
@@ -299,6 +331,20 @@ class DrasticApplication(object):
             self.print_error(res.msg())
             return res.code()
 
+    def batch(self, args):
+        """Run the commands of a file, one per line, in this process."""
+        from cli.batch import run_batch
+        jobs = int(args['--jobs'] or BATCH_JOBS)
+        # One client, and pool of connections, for all the lines
+        if self.load_client() is not None:
+            self.client = self.get_client(args, pool_size=jobs)
+        if args['<batch-file>'] == '-':
+            failed = run_batch(self, sys.stdin, jobs)
+        else:
+            with open(args['<batch-file>']) as fh:
+                failed = run_batch(self, fh, jobs)
+        return 1 if failed else 0
+
     def cd(self, args):
         "Move into a different container."
         client = self.get_client(args)
@@ -315,6 +361,7 @@ class DrasticApplication(object):
 
     def cdmi(self, args):
         "Display cdmi information (dict) for a path."
+        import json
         client = self.get_client(args)
         path = args['<path>']
         res = client.get_cdmi(path)
@@ -333,6 +380,7 @@ class DrasticApplication(object):
 
     def chmod(self, args):
         "Add or remove ACE to a path."
+        from cli.acl import str_to_cdmi_str_acemask
         client = self.get_client(args)
         path = unicode(args['<path>'], "utf-8")
         group = unicode(args['<group>'], "utf-8")
@@ -359,6 +407,7 @@ class DrasticApplication(object):
 
     def create_client(self, args):
         """Return a DrasticClient."""
+        from cli.client import DrasticClient
         url = args['--url']
         if not url:
             # Called without being connected
@@ -378,14 +427,18 @@ class DrasticApplication(object):
 
     def exit(self, args):
         "Close CDMI client session"
-        try:
-            os.remove(self.session_path)
-        except OSError:
-            # No saved client to log out
-            pass
+        agent.stop(self)
+        for path in (self.session_path, self.session_info_path):
+            try:
+                os.remove(path)
+            except OSError:
+                # No saved client to log out
+                pass
 
     def get(self, args):
         "Fetch a data object from the archive to a local file."
+        from requests.exceptions import ConnectionError
+        from cli.client import CHUNK_WINDOW
         src = unicode(args['<src>'], "utf-8")
         # Determine local filename
         if args['<dest>']:
@@ -395,7 +448,7 @@ class DrasticApplication(object):
 
         # Check for overwrite of existing file, directory, link
         if os.path.isfile(localpath):
-            if not args['--force']:
+            if not (args['--force'] or args.get('--resume')):
                 self.print_error(u"File '{0}' exists, --force option not used"
                                  "".format(localpath))
                 return errno.EEXIST
@@ -408,47 +461,113 @@ class DrasticApplication(object):
 
         client = self.get_client(args)
         try:
-            cfh = client.open(src)
-            if cfh.status_code == 404:
+            # Only the metadata, the value is fetched below
+            res = client.get_metadata(src)
+            if not res.ok():
                 self.print_error(u"'{0}': No such object or container"
                                  "".format(src))
-                return 404
+                return res.code()
+            size = res.json().get('cdmi_size')
+            if size is None:
+                # Size unknown, stream the object in one request
+                cfh = client.open(src)
+                if cfh.status_code == 404:
+                    cfh.close()
+                    self.print_error(u"'{0}': No such object or container"
+                                     "".format(src))
+                    return 404
+                lfh = open(localpath, 'wb')
+                for chunk in cfh.iter_content(8192):
+                    lfh.write(chunk)
+                lfh.close()
+                print(localpath)
+                return
+            # Keep track of the ranges written, so an interrupted download can
+            # be resumed with --resume. The offsets only mean something for
+            # the chunk size and the object size of the first line.
+            ranges_path = localpath + '.ranges'
+            chunk_size = int(args.get('--chunk-size') or GET_CHUNK_SIZE)
+            header = '{0} {1}\n'.format(chunk_size, int(size))
+            done = set()
+            if args.get('--resume') and os.path.isfile(ranges_path):
+                with open(ranges_path, 'r') as fh:
+                    if fh.readline() != header:
+                        self.print_error(u"'{0}': cannot resume, the object or "
+                                         "the --chunk-size changed - use "
+                                         "--force to start over"
+                                         "".format(localpath))
+                        return errno.EINVAL
+                    done = set(int(l) for l in fh if l.strip())
+                if not os.path.isfile(localpath):
+                    # The ranges written are gone with the file
+                    done = set()
+            with open(ranges_path, 'a' if done else 'w') as rfh:
+                if not done:
+                    rfh.write(header)
+                    rfh.flush()
+
+                def progress(start):
+                    rfh.write('{0}\n'.format(start))
+                    rfh.flush()
+                res = client.get_chunked(src, localpath, int(size), chunk_size,
+                                         int(args.get('--window') or
+                                             CHUNK_WINDOW),
+                                         done, progress)
         except ConnectionError as e:
             self.print_error("'{0}': Redirection failed - Reference isn't accessible"
                              "".format(e.request.url, e.strerror))
             return 404
-        lfh = open(localpath, 'wb')
-        for chunk in cfh.iter_content(8192):
-            lfh.write(chunk)
-        lfh.close()
+        if not res.ok():
+            self.print_error(u"'{0}': {1} - use --resume to continue the "
+                             "download".format(src, res.msg()))
+            return res.code()
+        os.remove(ranges_path)
         print(localpath)
 
-    def get_client(self, args):
+    def get_client(self, args, pool_size=None):
         """Return a DrasticClient.
 
         This may be achieved by loading a DrasticClient with a previously saved
-        session.
+        session. ``pool_size`` sets the number of keep-alive connections kept
+        per host, it can be overridden on the command line with --pool-size.
         """
-        try:
-            # Load existing session, so as to keep current dir etc.
-            with open(self.session_path, 'rb') as fh:
-                client = pickle.load(fh)
-        except (IOError, pickle.PickleError):
+        # Held by the agent or a batch, with its connections, or the
+        # existing session, so as to keep current dir etc.
+        client = self.client or self.load_client()
+        if client is None:
             # Init a new DrasticClient
             client = self.create_client(args)
         if args['--url']:
             if client.url != args['--url']:
                 # Init a fresh DrasticClient
                 client = self.create_client(args)
-        client.session = requests.Session()
+        if args.get('--pool-size'):
+            pool_size = int(args['--pool-size'])
+        if client is self.client and (pool_size or args.get('--trace')):
+            # Shared by the lines of a batch, the options of this one apply to
+            # a copy of it, with connections of its own and no tracer
+            import pickle
+            client = pickle.loads(pickle.dumps(client, pickle.HIGHEST_PROTOCOL))
+        if pool_size:
+            client.set_pool_size(pool_size)
+        if args.get('--trace'):
+            from cli.trace import JSONLSink
+            client.set_tracer(JSONLSink(args['--trace']))
         return client
 
     def init(self, args):
         """Initialize a CDMI client session.
 
-        Optionally log in using HTTP Basic username and password credentials.
+        Optionally log in using HTTP Basic username and password credentials,
+        and/or start an agent holding the session (--agent).
         """
+        from getpass import getpass
+        # A running agent holds the session being replaced
+        agent.stop(self)
         client = self.get_client(args)
+        if not args['--url']:
+            # init --agent, for the current session
+            return self.start_agent(client)
         if args['--username']:
             username = unicode(args['--username'], "utf-8")
         else:
@@ -480,10 +599,26 @@ class DrasticApplication(object):
                   " Anonymous access".format(color))
         # Save the client for future use
         self.save_client(client)
+        if args['--agent']:
+            return self.start_agent(client)
         return 0
 
+    def load_client(self):
+        """Return the DrasticClient of the saved session, None if there is
+        none."""
+        import pickle
+        try:
+            with open(self.session_path, 'rb') as fh:
+                return pickle.load(fh)
+        except (IOError, pickle.PickleError):
+            return None
+
     def ls(self, args):
         """List a container."""
+        from operator import methodcaller
+        from cli.acl import cdmi_str_to_str_acemask
+        if args.get('--unsorted') or args.get('--page-size'):
+            return self.ls_paged(args)
         client = self.get_client(args)
         if args['<path>']:
             path = unicode(args['<path>'], "utf-8")
@@ -530,6 +665,62 @@ class DrasticApplication(object):
         else:
             self.print_error(res.msg())
 
+    def ls_paged(self, args):
+        """List a container page by page, with ls_iter.
+
+        With --unsorted each child is printed as it arrives, otherwise the
+        names are sorted once they are all in, as ls does.
+        """
+        from itertools import chain
+        from operator import methodcaller
+        from cli.acl import cdmi_str_to_str_acemask
+        from cli.client import LS_PAGE_SIZE
+        from cli.errors import HTTPError
+        page_size = args.get('--page-size') or str(LS_PAGE_SIZE)
+        if not page_size.isdigit() or int(page_size) < 1:
+            self.print_error(u"--page-size must be a positive number, not "
+                             "'{0}'".format(page_size))
+            return errno.EINVAL
+        client = self.get_client(args)
+        path = unicode(args['<path>'], "utf-8") if args['<path>'] else None
+        children = client.ls_iter(path, int(page_size))
+        try:
+            # The first page tells whether the container is there
+            first = next(children, None)
+            pwd = client.pwd()
+            if path is None:
+                print("Root:" if pwd == "/" else u"{}:".format(pwd))
+            else:
+                print(u"{}{}:".format(pwd, path))
+            if args['-a']:
+                res = client.get_metadata((path or pwd).rstrip('/') + '/')
+                cdmi_acl = res.json().get("cdmi_acl", []) if res.ok() else []
+                if cdmi_acl:
+                    for ace in cdmi_acl:
+                        print("  ACL - {}: {}".format(
+                            ace['identifier'],
+                            cdmi_str_to_str_acemask(ace['acemask'], False)
+                            ))
+                else:
+                    print("  ACL: No ACE defined")
+            children = chain([] if first is None else [first], children)
+            if not args.get('--unsorted'):
+                children = list(children)
+                children = (
+                    sorted([x for x in children if x.endswith('/')],
+                           key=methodcaller('lower')) +
+                    sorted([x for x in children if not x.endswith('/')],
+                           key=methodcaller('lower')))
+            for child in children:
+                if child.endswith('/'):
+                    print(u'{0.blue}{1}{0.normal}'.format(color, child))
+                else:
+                    print(child)
+        except HTTPError as e:
+            self.print_error(e.msg)
+            return e.code
+        return 0
+
     def meta_add(self, args, replace=False):
         """Add metadata"""
         client = self.get_client(args)
@@ -644,6 +835,22 @@ class DrasticApplication(object):
         if not res.ok():
             self.print_error(res.msg())
 
+    def mget(self, arguments):
+        import mget
+        return mget.mget(self, arguments)
+
+    def mget_execute(self, arguments):
+        import mget
+        return mget.mget_execute(self, arguments)
+
+    def mget_prepare(self, arguments):
+        import mget
+        return mget.mget_prepare(self, arguments)
+
+    def mget_status(self, arguments):
+        import mget
+        return mget.mget_status(self, arguments)
+
     def mput(self, arguments):
         import mput
         return mput.mput(self, arguments)
@@ -676,6 +883,7 @@ class DrasticApplication(object):
 
     def put(self, args):
         "Put a file to a path."
+        from cli.client import CHUNK_WINDOW
         if args["--ref"]:
             return self.put_reference(args)
         src = unicode(args['<src>'], "utf-8")
@@ -693,7 +901,16 @@ class DrasticApplication(object):
             client = self.get_client(args)
             # To avoid reading large files into memory,
             # client.put() accepts file-like objects
-            res = client.put(dest, fh, mimetype=args["--mimetype"])
+            if args.get("--chunk-size"):
+                res = client.put_chunked(dest, fh,
+                                         mimetype=args["--mimetype"],
+                                         chunk_size=int(args["--chunk-size"]),
+                                         window=int(args.get("--window") or
+                                                    CHUNK_WINDOW),
+                                         verify=args.get("--verify"))
+            else:
+                res = client.put(dest, fh, mimetype=args["--mimetype"],
+                                 verify=args.get("--verify"))
             if res.ok():
                 cdmi_info = res.json()
                 print(cdmi_info[u'parentURI'] + cdmi_info[u'objectName'])
@@ -702,6 +919,7 @@ class DrasticApplication(object):
 
     def put_reference(self, args):
         "Create a reference at path dest with the url."
+        import json
         dest = unicode(args['<dest>'], "utf-8")
         url = args['<url>']
         client = self.get_client(args)
@@ -718,6 +936,10 @@ class DrasticApplication(object):
 
     def pwd(self, args):
         """Print working directory"""
+        info = self.session_info()
+        if info is not None:
+            print(info['pwd'])
+            return
         client = self.get_client(args)
         print(client.pwd())
 
@@ -746,15 +968,53 @@ class DrasticApplication(object):
             return self.rm(args)
 
     def save_client(self, client):
-        """Save the status of the DrasticClient for subsequent use."""
+        """Save the status of the DrasticClient for subsequent use.
+
+        What pwd and whoami show is also saved as plain JSON, see
+        session_info().
+        """
+        import json
+        import pickle
         if not os.path.exists(os.path.dirname(self.session_path)):
             os.makedirs(os.path.dirname(self.session_path))
         # Load existing session, so as to keep current dir etc.
         with open(self.session_path, 'wb') as fh:
             pickle.dump(client, fh, pickle.HIGHEST_PROTOCOL)
+        with open(self.session_info_path, 'w') as fh:
+            json.dump({'url': client.url, 'pwd': client.pwd(),
+                       'user': client.whoami()}, fh)
+
+    @property
+    def session_info_path(self):
+        return os.path.join(os.path.dirname(self.session_path), 'session.json')
+
+    def session_info(self):
+        """Return the url, current container and user of the saved session,
+        read without building a client, None if they were not saved."""
+        import json
+        try:
+            with open(self.session_info_path) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def start_agent(self, client):
+        """Start the agent of the session."""
+        if not hasattr(os, 'fork'):
+            self.print_error("The agent needs a POSIX system")
+            return 1
+        if not agent.start(self, client):
+            self.print_error("The agent did not start")
+            return 1
+        self.print_success(u"Agent listening on {}".format(agent.socket_path(self)))
+        return 0
 
     def whoami(self, args):
         """Print name of the user"""
+        info = self.session_info()
+        if info is not None:
+            print(info['user'] + " - " + info['url'])
+            return
         client = self.get_client(args)
         print(client.whoami() + " - " + client.url)
 
@@ -765,12 +1025,26 @@ def main():
                        version='Drastic CLI {}'.format(cli.__version__))
     app = DrasticApplication(SESSION_PATH)
 
+    if arguments['pwd'] or arguments['whoami']:
+        # Answered from the saved session, without the agent
+        return dispatch(app, arguments)
+
     # Set up console log levels (default=warn, quiet=error, debug=debug)
+    import logging
     log_level = logging.WARN
     if arguments.get('--debug'):  # debug overrides quiet
         log_level = logging.DEBUG
     logging.basicConfig(level=log_level)
 
+    if agent.forwardable(arguments):
+        code = agent.forward(app, sys.argv[1:])
+        if code is not None:
+            return code
+    return dispatch(app, arguments)
+
+
+def dispatch(app, arguments):
+    """Run the command parsed by docopt"""
     if arguments['init']:
         return app.init(arguments)
 
@@ -808,6 +1082,8 @@ def main():
         return app.chmod(arguments)
     elif arguments['exit']:
         return app.exit(arguments)
+    elif arguments['batch']:
+        return app.batch(arguments)
     elif arguments['pwd']:
         return app.pwd(arguments)
     elif arguments['ls']:
@@ -834,6 +1110,14 @@ def main():
         return app.mput_status(arguments)
     elif arguments['mput']:
         return app.mput(arguments)
+    elif arguments['mget-prepare']:
+        return app.mget_prepare(arguments)
+    elif arguments['mget-execute']:
+        return app.mget_execute(arguments)
+    elif arguments['mget-status']:
+        return app.mget_status(arguments)
+    elif arguments['mget']:
+        return app.mget(arguments)
 
 
 class win_color:
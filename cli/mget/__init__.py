@@ -0,0 +1,14 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from .mget import mget
+from .mget_execute import mget_execute
+from .mget_prepare import mget_prepare
+from .mget_status import mget_status
+
+__all__ = ('mget', 'mget_prepare', 'mget_status', 'mget_execute')
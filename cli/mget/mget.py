@@ -0,0 +1,46 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import os
+import time
+
+from ..mput.config import NUM_THREADS
+from ..mput.mput_threads import thread_setup
+from .mget_threads import file_getter
+from .utils import walk
+
+
+def mget(app, arguments):
+    """
+            drastic mget <src-dir-in-repo> <local-dir>
+
+    :param "DrasticApplication" app:
+    :param arguments:
+    :return:
+    """
+    client = app.get_client(arguments, pool_size=NUM_THREADS)
+    src = arguments['<src-dir-in-repo>']
+    local_dir = os.path.expanduser(arguments['<local-dir>'])
+
+    q, threads = thread_setup(NUM_THREADS, None, client, file_getter)
+    for t in threads : t.start()
+
+    ### Instrumentation
+    t0 = time.time()
+    ctr = 0
+    ### Actual mget loop ###
+    for path, names in walk(client, src):
+        for name in names:
+            ctr += 1
+            q.put((path + name, os.path.join(local_dir, path.lstrip('/'), name), None, 0))
+
+    q.join()
+    #####################
+    # Summary
+    t2 = time.time()
+    print '{0:,} fetched in {1:.2f} secs -- {2:.2f}/sec'.format(ctr, (t2-t0), ctr / (t2 - t0))
@@ -0,0 +1,42 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import os.path
+from Queue import Queue
+
+from ..mput.config import NUM_THREADS
+from ..mput.db import DB, DBWriter
+from ..mput.mput_threads import thread_setup
+from ..mput.utils import run_queue
+from .mget_threads import file_getter
+from .utils import QUEUE_PREFIX
+
+
+def mget_execute(app, arguments):
+    db = DB(app, arguments, prefix = QUEUE_PREFIX)
+    local_dir = os.path.expanduser(arguments['<local-dir>'])
+    db_queue = Queue(16*1024)
+    writer = DBWriter(db, db_queue)
+    writer.start()
+    client = app.get_client(arguments, pool_size=NUM_THREADS)
+    q, threads = thread_setup(NUM_THREADS, None, client, file_getter, db_queue = db_queue )
+    for t in threads : t.start()
+
+    debug = arguments.get('-D',0)
+    debug = int(debug) if isinstance(debug,basestring) and debug.isdigit() else 0
+
+    # Claim the objects a container at a time and fetch them, see run_queue
+    def entries(claim):
+        tgtdir = os.path.join(local_dir, claim[0][0].lstrip('/'))
+        return [(path + name, os.path.join(tgtdir, name), row_id, bytes_done)
+                for path, name, start_time, end_time, row_id, bytes_done, stamp in claim]
+    run_queue(db, q, writer, entries, debug)
+
+    writer.stop()
+
+    print 'Done'
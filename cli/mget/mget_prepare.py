@@ -0,0 +1,34 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import time
+
+from ..mput.db import DB
+from .utils import QUEUE_PREFIX, walk
+
+
+def mget_prepare(app, arguments):
+    db = DB(app, arguments, prefix = QUEUE_PREFIX)
+    client = app.get_client(arguments)
+
+    ### Instrumentation
+    t0 = time.time()
+    t1 = t0
+    ctr = 0
+    for path, names in walk(client, arguments['<src-dir-in-repo>']):
+        db.insert_many((path, name, None, None) for name in names)
+        ctr += len(names)
+        t2 = time.time()
+        if ( t2 - t1 ) > 30 :
+            print '{0:,} registered in {1:.2f} secs -- {2:.2f}/sec'.format(ctr, (t2-t0), ctr / (t2 - t0))
+            t1 = t2
+
+    #####################
+    # Summary
+    t2 = time.time()
+    print '{0:,} registered in {1:.2f} secs -- {2:.2f}/sec'.format(ctr, (t2-t0), ctr / (t2 - t0))
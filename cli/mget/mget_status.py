@@ -0,0 +1,20 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import sys
+
+from ..mput.db import DB
+from .utils import QUEUE_PREFIX
+
+def mget_status(app, arguments):
+    reset_flag = bool(arguments.get('--reset', False))
+    clean_flag = bool(arguments.get('--clean', False))
+    clear_flag = bool(arguments.get('--clear', False))
+    db = DB(app, arguments, prefix = QUEUE_PREFIX)
+    print >> sys.stdout, db.status(reset=reset_flag, clear=clear_flag, clean=clean_flag)
+    return None
@@ -0,0 +1,76 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import os.path
+import time
+
+from ..mput.utils import failure, printable, retrying
+from .utils import makedirs
+
+
+def file_getter(q, client, cnx, cache = None , db_queue = None , **options ) :
+    """
+    Pull remote (source) object and local ( target ) file paths, fetch them, and then
+    report the status of the transfer.  Has the signature of mput's file_putter so that
+    mput_threads.thread_setup can start it.
+
+    :param q: Queue
+    :param client:  DrasticClient
+    :param cnx: N/A
+    :param cache: N/A
+    :param db_queue: Queue  where the ( row_id , state , T0 , T1 , result ) of each transfer is put
+    :return: N/A
+    """
+    while True:
+        entry = q.get()
+        try :
+            src, target, row_id, _ = entry
+            T0 = time.time()
+            try :
+                ret = retrying(lambda: file_getter_worker(src, target, client))
+            except Exception as e :
+                ret = failure(u'failed to get {} to {} [{} / {}]'.format(src, target, type(e).__name__, e), exc = e)
+            T1 = time.time()
+
+            if ret['ok'] : status = 'DONE'
+            else :
+                status = 'FAIL'
+                print printable(ret['msg'])
+            if db_queue :
+                db_queue.put((row_id,status,T0,T1,ret))
+        finally :
+            # Only once the status is queued, so it is written before the writer stops, and
+            # whatever happened, or q.join() waits forever
+            q.task_done()
+
+
+def file_getter_worker(src, target, client):
+    """
+    :param src: basestring       -- path of the data object in the archive
+    :param target: basestring    -- local file to write
+    :param client:  DrasticClient
+    :return: dict
+    """
+    try:
+        makedirs(os.path.dirname(target))
+        res = client.open(src)
+        if res.status_code != 200 :
+            res.close()
+            return failure(u'failed to get {} [{}]'.format(src, res.status_code), status = res.status_code)
+        # Write to a temporary name, so that an interrupted transfer never looks complete
+        partial = target + '.part'
+        written = 0
+        with open(partial, 'wb') as fh:
+            for chunk in res.iter_content(64 * 1024):
+                fh.write(chunk)
+                written += len(chunk)
+        os.rename(partial, target)
+        print 'got ', printable(target)
+        return {'ok' : True , 'bytes' : written }
+    except Exception as e:
+        return failure(u'failed to get {} to {} [{} / {}]'.format(src, target, type(e).__name__, e), exc = e)
@@ -0,0 +1,51 @@
+"""
+
+Drastic Command Line Interface -- multiple get.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import errno
+import os
+import sys
+
+from cli.errors import HTTPError
+
+# Name of the mget work queues in the session directory
+QUEUE_PREFIX = 'fetch_queue'
+
+
+def walk(client, top):
+    """
+        Walk a container tree of the archive, top down.
+
+    :param client: DrasticClient
+    :param top: basestring  path of the container to walk
+    :return: iterator on ( container path , [ data object names ] )
+    """
+    dirs = [ top.rstrip('/') + '/' ]
+    while dirs :
+        path = dirs.pop()
+        names, subdirs = [], []
+        try :
+            # Page by page, a huge container is never read in one response
+            for x in client.ls_iter(path) :
+                ( subdirs if x.endswith('/') else names ).append(x)
+        except HTTPError as e :
+            print >> sys.stderr, u"can't list {} -- {}".format(path, e.msg)
+            continue
+        # Pushed in reverse so they are listed in order
+        dirs.extend( path + x for x in reversed(subdirs) )
+        yield path, names
+
+
+def makedirs(path):
+    """
+        Create a local directory and its parents, a directory created by another thread is fine.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
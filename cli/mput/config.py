@@ -1 +1,5 @@
 NUM_THREADS = 8  # Number of writing threads to set up ...
+ASYNC_INFLIGHT = 256  # Number of PUTs kept in flight by the async engine ...
+SCAN_THREADS = 16  # Number of directory listing threads of the --walk scanner ...
+RETRIES = 2  # Number of times a transient failure is retried at once, by the worker ...
+RETRY_DELAY = 1.0  # Seconds before the first of those retries, doubled for each one ...
@@ -0,0 +1,104 @@
+"""
+
+Drastic Command Line Interface -- multiple put.
+
+    Adaptive control of the number of workers putting files at the same time.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import threading
+import time
+
+from .config import NUM_THREADS
+
+
+def controller_setup(arguments):
+    """
+        Return the ConcurrencyController asked for with --min-threads/--max-threads, if any
+    """
+    if not (arguments.get('--min-threads') or arguments.get('--max-threads')) :
+        return None
+    return ConcurrencyController(int(arguments.get('--min-threads') or 1),
+                                 int(arguments.get('--max-threads') or 4 * NUM_THREADS))
+
+
+class ConcurrencyController(object):
+    """
+        Additive increase / multiplicative decrease of the number of active workers.
+
+        All the workers are started, but only 'limit' of them may have a PUT in flight.
+        Every 'interval' seconds the results of the PUTs finished since the last
+        adjustment are looked at:
+          - more than 'error_rate' of them failed with a server error (5xx) or a
+            connection error                               -> halve the limit
+          - the average latency grew past 'latency_factor' times the best seen,
+            without any gain in throughput                 -> one worker less
+          - otherwise                                      -> one worker more
+        and the limit is kept between 'minimum' and 'maximum'.
+    """
+
+    def __init__(self, minimum, maximum, interval = 2.0, error_rate = 0.05, latency_factor = 2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = self.minimum
+        self.interval = interval
+        self.error_rate = error_rate
+        self.latency_factor = latency_factor
+        self.active = 0
+        self.cond = threading.Condition()
+        ### Statistics of the current window
+        self.count = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.T0 = time.time()
+        ### Memory of the previous windows
+        self.last_rate = None
+        self.best_latency = None
+
+    def acquire(self):
+        """ Wait until this worker is allowed to start a PUT """
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency, ok, status = None):
+        """
+            Report the end of a PUT
+
+        :param latency: float  seconds taken by the PUT
+        :param ok: bool
+        :param status: int  HTTP status of a failed PUT, None for a connection error
+        """
+        with self.cond:
+            self.active -= 1
+            self.count += 1
+            self.latency += latency
+            if not ok and (status is None or status >= 500):
+                self.errors += 1
+            self.adjust()
+            self.cond.notify_all()
+
+    def adjust(self):
+        """ Move the limit once per interval, called with the condition held """
+        T1 = time.time()
+        if T1 - self.T0 < self.interval or not self.count:
+            return
+        rate = self.count / (T1 - self.T0)
+        latency = self.latency / self.count
+        if self.errors > self.error_rate * self.count:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif (self.best_latency and latency > self.latency_factor * self.best_latency
+              and self.last_rate and rate <= self.last_rate):
+            self.limit = max(self.minimum, self.limit - 1)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        self.last_rate = rate
+        self.count, self.errors, self.latency, self.T0 = 0, 0, 0.0, T1
+
+    def __str__(self):
+        return 'workers = {} [{}-{}]'.format(self.limit, self.minimum, self.maximum)
@@ -9,12 +9,184 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
 import os
+import socket
 import sqlite3
 import sys
+import time
+import uuid
+from contextlib import contextmanager
+from Queue import Empty
+from threading import Event, RLock, Thread
+
+
+# Columns added to the transfer table after its first release, work queues
+# created by older versions are upgraded when they are opened.
+EXTRA_COLUMNS = (
+    ('bytes_done', 'INTEGER NOT NULL DEFAULT 0'),   # acknowledged bytes of a chunked upload
+    ('size', 'INTEGER'),                            # size of the source file when it was queued
+    ('mtime', 'REAL'),                              # modification time of the source file when it was queued
+    ('hash', 'TEXT'),                               # md5 of the source file when it was queued ( --checksum )
+    ('done_size', 'INTEGER'),                       # size, mtime and hash of the last successful upload
+    ('done_mtime', 'REAL'),
+    ('done_hash', 'TEXT'),
+    ('owner', 'TEXT'),                              # executor holding the claim of a WRK row
+    ('lease_until', 'REAL'),                        # the claim may be taken over by another executor after this
+    ('attempts', 'INTEGER NOT NULL DEFAULT 0'),     # failed transfers of the row so far
+    ('last_error', 'TEXT'),                         # why the last one failed
+    ('not_before', 'REAL'),                         # a failed row is not retried before this
+    ('http_status', 'INTEGER'),                     # HTTP status of the last failure, if the server answered
+    ('error_class', 'TEXT'),                        # exception ( or 'HTTP' ) of the last failure
+    ('bytes_sent', 'INTEGER'),                      # bytes acknowledged by the last transfer
+    ('part_size', 'INTEGER'),                       # size and mtime of the source file when bytes_done
+    ('part_mtime', 'REAL'),                         # was acknowledged, a resume needs them unchanged
+)
+
+# Record the outcome of a transfer, a successful one also remembers what was sent so
+# that a later mput-prepare --sync can tell whether the file has changed since.
+# A transient failure goes back to RDY, to be retried after a capped exponential backoff,
+# until it has failed :max_attempts times and is left in FAIL.  A permanent one stays in FAIL.
+# With an owner, nothing is recorded for a row whose claim has been taken over by another executor.
+RECORD_STATE = '''UPDATE transfer SET
+                    state = CASE WHEN :state = 'FAIL' AND :transient AND attempts + 1 < :max_attempts THEN 'RDY' ELSE :state END ,
+                    start_time = :T0 , end_time = :T1 ,
+                    done_size  = CASE WHEN :state = 'DONE' THEN size  ELSE done_size  END ,
+                    done_mtime = CASE WHEN :state = 'DONE' THEN mtime ELSE done_mtime END ,
+                    done_hash  = CASE WHEN :state = 'DONE' THEN hash  ELSE done_hash  END ,
+                    attempts   = CASE WHEN :state = 'FAIL' THEN attempts + 1 ELSE attempts END ,
+                    last_error  = CASE WHEN :state = 'FAIL' THEN :error       ELSE last_error  END ,
+                    http_status = CASE WHEN :state = 'FAIL' THEN :http_status ELSE http_status END ,
+                    error_class = CASE WHEN :state = 'FAIL' THEN :error_class ELSE error_class END ,
+                    bytes_sent = :bytes_sent ,
+                    not_before = CASE WHEN :state = 'FAIL' THEN :T1 + min(:backoff_max, :backoff * (1 << min(attempts, 20))) END ,
+                    lease_until = NULL
+                  WHERE row_id = :row_id AND ( :owner IS NULL OR owner = :owner )'''
+
+
+def record(row_id, state, T0, T1, result = None, owner = None, max_attempts = None):
+    """
+        Parameters of RECORD_STATE for the outcome of one transfer
+    :param result: dict  what the worker returned, see mput.utils.failure()
+    """
+    result = result or {}
+    return dict(row_id = row_id, state = state, T0 = T0, T1 = T1, owner = owner,
+                error = result.get('msg'), http_status = result.get('status'), error_class = result.get('error'),
+                transient = result.get('transient', True), bytes_sent = result.get('bytes'),
+                max_attempts = max_attempts or MAX_ATTEMPTS, backoff = BACKOFF, backoff_max = BACKOFF_MAX)
+
+
+# Requeue a file of a sync that differs from what was last sent ( for a DONE row ) or from
+# what was queued ( for a RDY or FAIL row, which restarts any partial chunked upload ).
+# Rows being transferred are left alone, their new size and mtime are picked up by the next sync.
+# A hash is only compared when both sides have one.
+SYNC_ROW = '''UPDATE transfer SET state = 'RDY' , size = :size , mtime = :mtime , hash = :hash , bytes_done = 0
+               WHERE path = :path AND name = :name AND state <> 'WRK' AND
+                 CASE WHEN state = 'DONE'
+                   THEN done_size IS NOT :size OR done_mtime IS NOT :mtime OR ifnull(done_hash, :hash) IS NOT ifnull(:hash, done_hash)
+                   ELSE size IS NOT :size OR mtime IS NOT :mtime OR ifnull(hash, :hash) IS NOT ifnull(:hash, hash)
+                 END'''
+
+# A file sent without a hash that is unchanged by size and mtime takes the hash of this sync as
+# the one it was sent with ( the usual quick check assumption ), so that --checksum catches
+# later changes that keep the size and mtime.
+SYNC_HASH = '''UPDATE transfer SET hash = :hash , done_hash = :hash
+                WHERE path = :path AND name = :name AND state = 'DONE' AND :hash IS NOT NULL AND
+                  done_hash IS NULL AND done_size IS :size AND done_mtime IS :mtime'''
+
+# Indexes of the transfer table that bulk_load() may defer, see create_indexes()
+SECONDARY_INDEXES = ('t_path1_idx', 't_state_idx', 't_state1_idx', 't_path_idx')
+
+
+# What mput-execute --skip-existing found in the archive, see DB.remote_listing()
+REMOTE_TTL = 24 * 3600.0            # seconds a listing of a target container is trusted
+
+
+# Claims of mput-execute / mget-execute, see DB.get_and_lock()
+CLAIM_ROWS = 1000                   # at most this many files per claim
+CLAIM_BYTES = 1024 * 1024 * 1024    # ... or about this many bytes, so a large directory is shared out
+LEASE_TIME = 3600.0                 # seconds before the claim of an executor that went away can be taken over
+# The lease of a claim is only renewed by the DBWriter of its executor, every quarter of the lease
+# ( see DBWriter.run ).  A renewal waits for the write lock, and the writer itself may be held up by a
+# batch of updates, up to BUSY_TIMEOUT each:  a lease shorter than this would let a live executor lose
+# its rows to another one, and both would send them.  An executor that claims rows without a DBWriter
+# must finish them within the lease.
+MIN_LEASE = 240.0
+
+# Retries of failed transfers
+MAX_ATTEMPTS = 5                    # a row fails for good after this many failed transfers
+BACKOFF = 30.0                      # seconds before the first retry, doubled for every further failure
+BACKOFF_MAX = 3600.0                # ... up to this
+
+# File systems where the WAL shared memory index cannot be shared between hosts
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'lustre', 'cifs', 'smbfs', 'smb3', 'gpfs', 'beegfs', 'ceph', 'fuse.sshfs', 'glusterfs')
+
+
+# Connection settings of the work queues
+BUSY_TIMEOUT = 60.0                 # seconds to wait for a lock held by another connection
+CACHE_SIZE = 64 * 1024              # KiB of page cache per connection
+MMAP_SIZE = 256 * 1024 * 1024       # bytes of the database file read through mmap
+
+
+def network_filesystem(path):
+    """
+        True if path is on one of the NETWORK_FILESYSTEMS, as far as /proc/mounts tells.
+    """
+    try :
+        with open('/proc/mounts') as fp :
+            mounts = [line.split()[1:3] for line in fp]
+    except (IOError, OSError) :
+        return False
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    for mountpoint, kind in mounts :
+        mountpoint = mountpoint.replace('\\040', ' ')
+        if (path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/')) and len(mountpoint) >= len(best) :
+            best, fstype = mountpoint, kind
+    return fstype in NETWORK_FILESYSTEMS
+
+
+def connect(dbname):
+    """
+        Open a work queue database, tuned for one writer and many readers.
+
+        In WAL mode readers ( mput-status polling a running mput-execute ) never block the
+        writer and the writer never blocks them; synchronous=NORMAL only syncs at checkpoints,
+        which is safe in WAL mode.  A connection waits up to BUSY_TIMEOUT seconds for a lock
+        held by another one before raising 'database is locked'.
+
+        WAL needs the processes to share memory, so a queue on a network file system, which
+        executors on several hosts may be using at once, keeps the rollback journal.
+
+    :param dbname: basestring  path of the database file
+    :return: sqlite3.Connection
+    """
+    cnx = sqlite3.connect(dbname, timeout = BUSY_TIMEOUT, check_same_thread = False )
+    cs = cnx.cursor()
+    if network_filesystem(os.path.dirname(os.path.abspath(dbname))) :
+        cs.execute('PRAGMA journal_mode = DELETE')
+        cs.execute('PRAGMA synchronous = FULL')
+        cs.execute('PRAGMA busy_timeout = {}'.format(int(BUSY_TIMEOUT * 1000)))
+        cs.close()
+        return cnx
+    mode = cs.execute('PRAGMA journal_mode = WAL').fetchone()
+    if not mode or mode[0].lower() != 'wal':
+        # Not supported by this sqlite or this filesystem, keep the rollback journal
+        print >> sys.stderr, 'WAL journal not available for {}, using {}'.format(dbname, mode and mode[0])
+    cs.execute('PRAGMA synchronous = NORMAL')
+    cs.execute('PRAGMA cache_size = -{}'.format(CACHE_SIZE))
+    cs.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+    cs.execute('PRAGMA busy_timeout = {}'.format(int(BUSY_TIMEOUT * 1000)))
+    cs.close()
+    return cnx
 
 
 class DB:
-    def __init__(self, app, args):
+    def __init__(self, app, args, prefix = 'work_queue'):
+        """
+            Open ( or create ) the work queue of a label
+        :param app: DrasticApplication
+        :param args: docopt arguments
+        :param prefix: basestring  the kind of queue, 'work_queue' for mput, 'fetch_queue' for mget
+        """
         p = app.session_path
 
         # set the label to the first candidate...
@@ -25,9 +197,9 @@ class DB:
             v = base64.b64encode(hashlib.md5(s).digest(),'-#').rstrip('=')
             return v
         if label == 'transfer' :
-            safename = 'work_queue-00.db'
+            safename = '{}-00.db'.format(prefix)
         else:
-            safename = 'work_queue-{}.db'.format(safe(label))
+            safename = '{}-{}.db'.format(prefix, safe(label))
 
         # construct the path
         if os.path.isfile(p): p,_ = os.path.split(p)
@@ -43,12 +215,17 @@ class DB:
 
         # open or create the database
         try :
-            self.cnx = sqlite3.connect(self.dbname , check_same_thread = False )
+            self.cnx = connect(self.dbname)
         except Exception as e :
             print e
             raise RuntimeError("Cannot open {}".format(self.dbname))
         #####
         self.cs = self.cnx.cursor()
+        self.lock = RLock()         # the connection is shared by the main thread and the DBWriter
+        # Identifies the claims of this executor, the random part guards against a reused pid
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease = max(float(args.get('--lease') or LEASE_TIME), MIN_LEASE)
+        self.max_attempts = int(args.get('--max-attempts') or MAX_ATTEMPTS)
 
 
 
@@ -61,6 +238,22 @@ class DB:
                  UNIQUE ( path,name )
                   ) ''' )
 
+        # The children of the target containers, and the size and hash of those that were looked at
+        self.cs.execute('''CREATE TABLE IF NOT EXISTS remote_listing
+                (container TEXT PRIMARY KEY , listed REAL NOT NULL ) ''' )
+        self.cs.execute('''CREATE TABLE IF NOT EXISTS remote_cache
+                (container TEXT , name TEXT , size INTEGER , hash TEXT ,
+                 PRIMARY KEY ( container , name ) ) ''' )
+
+        self.create_indexes()
+        self.upgrade()
+        self.cs.connection.commit()
+
+    def create_indexes(self):
+        """
+            Create the secondary indexes of the transfer table ( the UNIQUE ( path,name ) one is
+            part of the table and always present )
+        """
         self.cs.execute('''CREATE INDEX IF NOT EXISTS "t_path1_idx"  ON "transfer"(path)   ''' )
         try:
 
@@ -72,7 +265,42 @@ class DB:
             print 'Falling back to full indexes ... you may wish to consider updating your version of sqlite'
             self.cs.connection.rollback()
             self.cs.execute('''CREATE INDEX IF NOT EXISTS t_state_idx  ON transfer (state)''' )     # Fallback to full  index if partial fails.
-        self.cs.connection.commit()
+
+    @contextmanager
+    def bulk_load(self):
+        """
+            Load a fresh work queue without maintaining the secondary indexes row by row.
+
+            When the transfer table is empty the indexes are dropped for the duration of the
+            load and built once at the end, a sort of the finished table is much cheaper than
+            millions of b-tree updates.  A queue that already holds rows keeps its indexes,
+            rebuilding them for a small top-up would cost more than it saves.
+        """
+        fresh = self.cs.execute('SELECT 1 FROM transfer LIMIT 1').fetchone() is None
+        if fresh:
+            for index in SECONDARY_INDEXES:
+                self.cs.execute('DROP INDEX IF EXISTS "{}"'.format(index))
+            self.cs.connection.commit()
+        try:
+            yield self
+        finally:
+            if fresh:
+                self.create_indexes()
+                self.cs.connection.commit()
+
+    def upgrade(self):
+        """
+            Add the columns missing from a work queue created by an older version
+        """
+        have = set(row[1] for row in self.cs.execute('PRAGMA table_info(transfer)'))
+        for name, decl in EXTRA_COLUMNS:
+            if name not in have:
+                self.cs.execute('ALTER TABLE transfer ADD COLUMN {} {}'.format(name, decl))
+        if 'done_size' not in have:
+            # The files sent by an older version were sent as they were queued, or the first
+            # --sync would find them all changed and send them again
+            self.cs.execute('''UPDATE transfer SET done_size = size , done_mtime = mtime , done_hash = hash
+                               WHERE state = 'DONE' ''')
 
 
     def update(self, rowid, state):
@@ -80,38 +308,228 @@ class DB:
             cmd = '''UPDATE transfer SET state = ? , start_time = strftime('%s','now') Where row_id = ?'''
         else:
             cmd = '''UPDATE transfer SET state = ? , end_time = strftime('%s','now') Where row_id = ?'''
-        try:
-            self.cs.execute(cmd, [state, rowid])
-            self.cs.connection.commit()
-            return rowid
-        except Exception as e:
-            print e
-            self.cs.connection.rollback()
-            return None
+        with self.lock:
+            try:
+                self.cs.execute(cmd, [state, rowid])
+                self.cs.connection.commit()
+                return rowid
+            except Exception as e:
+                print e
+                self.cs.connection.rollback()
+                return None
+
+    def update_many(self, states, offsets = ()):
+        """
+            Record the outcome of many transfers in one transaction
+        :param states: [ ( row_id , state , T0 , T1 , result ) ]  T0 and T1 are the start and end of the transfer
+        :param offsets: [ ( row_id , bytes acknowledged , ( size , mtime ) ) ]  progress of chunked uploads
+        :return: number of rows updated, None on failure
+        """
+        with self.lock:
+            try:
+                self.cs.executemany('''UPDATE transfer SET bytes_done = ? , part_size = ? , part_mtime = ?
+                                       Where row_id = ? AND owner = ?''',
+                                    [(offset, size, mtime, row_id, self.owner)
+                                     for row_id, offset, (size, mtime) in offsets])
+                self.cs.executemany(RECORD_STATE,
+                                    [record(row_id, state, T0, T1, result, self.owner, self.max_attempts)
+                                     for row_id, state, T0, T1, result in states])
+                self.cs.connection.commit()
+                return len(states)
+            except Exception as e:
+                print e
+                self.cs.connection.rollback()
+                return None
+
+    def set_offset(self, rowid, offset, stamp):
+        """
+            Record how much of a chunked upload has been acknowledged, so that it can be resumed
+        :param stamp: ( size , mtime )  of the source file, the upload starts over if they change
+        """
+        return rowid if self.update_many((), [(rowid, offset, stamp)]) is not None else None
 
     def get_and_lock(self):
         """
-            This function will get retrieve an entry where the
-        :return:
-        """
-        self.cs.execute('''BEGIN''')
-        ## Select A Path's worth of files.... where some are
-        cmd = '''WITH DIR as ( SELECT path from transfer WHERE STATE = 'RDY' order by path LIMIT 1)
-                    SELECT path ,name,start_time,end_time,row_id from transfer JOIN DIR USING (path) where STATE = 'RDY'
-            '''
-        self.cs.execute(cmd)
-        results = self.cs.fetchall()
-
-        data = [data[-1:] for data in results]
-        cmd = '''UPDATE transfer SET STATE = 'WRK' , start_time = strftime('%s','now') WHERE row_id = ?'''
-        if data :
-            self.cs.executemany(cmd,data)
+            Claim the next batch of ready entries for this executor.
+
+            A batch comes from a single directory, it holds at most CLAIM_ROWS entries or
+            about CLAIM_BYTES, so that several executors ( processes, or hosts sharing the
+            database file ) can work through one large directory together.  The claim runs in
+            a BEGIN IMMEDIATE transaction, which takes the write lock before reading: two
+            executors can never pick the same rows.  Claimed rows carry the owner id of this
+            executor and a lease, rows whose lease ran out ( their executor died ) are
+            ready to be claimed again ( see recover() ).  Rows waiting for a retry are not
+            claimed before their backoff is over.
+        :return: [ ( path , name , start_time , end_time , row_id , bytes_done , ( part_size , part_mtime ) ) ]
+        """
+        with self.lock:
+            return self._get_and_lock()
+
+    def _get_and_lock(self):
+        now = time.time()
+        self.cs.execute('''BEGIN IMMEDIATE''')
+        try:
+            self._recover(now)
+            first = self.cs.execute('''SELECT path FROM transfer WHERE state = 'RDY' AND ifnull(not_before, 0) <= ?
+                                       ORDER BY path LIMIT 1''', (now,)).fetchone()
+            results = []
+            if first :
+                cmd = '''SELECT path ,name,start_time,end_time,row_id,bytes_done, part_size, part_mtime,
+                                 ifnull(size,0) - bytes_done
+                          FROM transfer WHERE state = 'RDY' AND path = ? AND ifnull(not_before, 0) <= ? LIMIT ?'''
+                claimed = 0
+                for row in self.cs.execute(cmd, (first[0], now, CLAIM_ROWS)) :
+                    results.append(row[:6] + (row[6:8],))
+                    claimed += row[8]
+                    if claimed >= CLAIM_BYTES : break
+                cmd = '''UPDATE transfer SET STATE = 'WRK' , start_time = strftime('%s','now') , owner = ? , lease_until = ?
+                          WHERE row_id = ?'''
+                self.cs.executemany(cmd, [(self.owner, now + self.lease, row[4]) for row in results])
             self.cs.connection.commit()
-        else :
+        except Exception:
             self.cs.connection.rollback()
+            raise
         # And unicode the results...
         return results
 
+    def recover(self):
+        """
+            Put the rows of executors whose lease ran out back in the queue, counting it as a failed
+            attempt ( the file may well be what brought the executor down ).
+        :return: number of rows recovered
+        """
+        with self.lock:
+            try:
+                n = self._recover(time.time())
+                self.cs.connection.commit()
+                return n
+            except Exception:
+                self.cs.connection.rollback()
+                raise
+
+    def _recover(self, now):
+        self.cs.execute('''UPDATE transfer SET state = CASE WHEN attempts + 1 < ? THEN 'RDY' ELSE 'FAIL' END ,
+                              attempts = attempts + 1 , last_error = 'lease of ' || ifnull(owner, 'unknown executor') || ' expired' ,
+                              error_class = 'LeaseExpired' , http_status = NULL , lease_until = NULL
+                            WHERE state = 'WRK' AND ifnull(lease_until, 0) < ?''', (self.max_attempts, now))
+        return self.cs.rowcount
+
+    def renew(self):
+        """
+            Extend the lease of every row claimed by this executor
+        """
+        with self.lock:
+            try:
+                self.cs.execute('''UPDATE transfer SET lease_until = ? WHERE state = 'WRK' AND owner = ?''',
+                                (time.time() + self.lease, self.owner))
+                self.cs.connection.commit()
+            except sqlite3.OperationalError as e:
+                print >> sys.stderr, 'failed to renew the lease of {} -- {}'.format(self.owner, e)
+                self.cs.connection.rollback()
+
+    def remaining(self):
+        """
+            ( files , bytes ) not transferred yet, for an ETA
+        """
+        with self.lock:
+            row = self.cs.execute('''SELECT count(*), sum(max(ifnull(size, 0) - bytes_done, 0))
+                                     FROM transfer WHERE state IN ('RDY', 'WRK')''').fetchone()
+            return row[0], row[1] or 0
+
+    def distinct_paths(self):
+        """
+            The source directories with files ready to go, one each.
+        """
+        with self.lock:
+            return [row[0] for row in self.cs.execute('''SELECT DISTINCT path FROM transfer WHERE state = 'RDY' ''')]
+
+    def ready_files(self, path):
+        """
+            The files of a source directory that are ready to go
+        :return: [ ( row_id , name , size , hash ) ]
+        """
+        with self.lock:
+            return self.cs.execute('''SELECT row_id, name, size, hash FROM transfer
+                                      WHERE path = ? AND state = 'RDY' ''', (path,)).fetchall()
+
+    def remote_listing(self, container, ttl = REMOTE_TTL):
+        """
+            The children of a target container as last listed, None if it was not listed in the last ttl seconds
+        :return: { name : ( size , hash ) }  size and hash are None until the object has been looked at
+        """
+        with self.lock:
+            row = self.cs.execute('SELECT listed FROM remote_listing WHERE container = ?', (container,)).fetchone()
+            if row is None or row[0] < time.time() - ttl:
+                return None
+            return dict((name, (size, hash)) for name, size, hash in
+                        self.cs.execute('SELECT name, size, hash FROM remote_cache WHERE container = ?', (container,)))
+
+    def remote_store(self, container, children = None, objects = ()):
+        """
+            Remember a new listing of a target container and/or what was found about some of its objects
+        :param children: iterable of names, the whole listing, None to keep the one there is
+        :param objects: iterable of ( name , size , hash )
+        """
+        with self.lock:
+            try:
+                if children is not None:
+                    self.cs.execute('DELETE FROM remote_cache WHERE container = ?', (container,))
+                    self.cs.executemany('INSERT OR IGNORE INTO remote_cache (container, name) VALUES ( ? , ? )',
+                                        ((container, name) for name in children))
+                    self.cs.execute('INSERT OR REPLACE INTO remote_listing (container, listed) VALUES ( ? , ? )',
+                                    (container, time.time()))
+                self.cs.executemany('UPDATE remote_cache SET size = ? , hash = ? WHERE container = ? AND name = ?',
+                                    ((size, hash, container, name) for name, size, hash in objects))
+                self.cs.connection.commit()
+            except Exception:
+                self.cs.connection.rollback()
+                raise
+
+    def remote_forget(self, container):
+        """
+            Drop what is known of a target container, files are about to be put in it
+        """
+        with self.lock:
+            try:
+                self.cs.execute('DELETE FROM remote_listing WHERE container = ?', (container,))
+                self.cs.execute('DELETE FROM remote_cache WHERE container = ?', (container,))
+                self.cs.connection.commit()
+            except Exception:
+                self.cs.connection.rollback()
+                raise
+
+    def mark_present(self, rows):
+        """
+            Record files found identical in the archive as sent, without transferring them
+        :param rows: iterable of ( row_id , hash )  the hash they were compared with, if any
+        :return: the number of entries marked DONE
+        """
+        rows = list(rows)
+        if not rows :               # rowcount would be -1
+            return 0
+        now = time.time()
+        with self.lock:
+            try:
+                self.cs.executemany('''UPDATE transfer SET state = 'DONE' , start_time = ? , end_time = ? ,
+                                         hash = ifnull(?, hash) , done_size = size , done_mtime = mtime ,
+                                         done_hash = ifnull(?, hash) , bytes_sent = 0
+                                       WHERE row_id = ? AND state = 'RDY' ''',
+                                    ((now, now, hash, hash, row_id) for row_id, hash in rows))
+                marked = self.cs.rowcount
+                self.cs.connection.commit()
+                return marked
+            except Exception:
+                self.cs.connection.rollback()
+                raise
+
+    def next_ready(self):
+        """
+            When the next ready row may be claimed, None if there is none left.
+        """
+        with self.lock:
+            row = self.cs.execute('''SELECT count(*), min(ifnull(not_before, 0)) FROM transfer WHERE state = 'RDY' ''').fetchone()
+            return row[1] if row[0] else None
+
     def insert(self, path):
         """
             Put a new path in , or ignore if it is already there.
@@ -127,8 +545,51 @@ class DB:
         self.cs.connection.commit()
         return ret
 
+    def insert_many(self, rows):
+        """
+            Put a batch of entries in, in a single transaction, ignoring those already there.
+            Nothing is checked on the local disk, so this can queue remote objects.
+            :rows: iterable of ( path, name, size, mtime ), size and mtime may be None
+            :return: the number of entries actually added
+        """
+        cmd = '''insert or ignore INTO transfer (path,name,size,mtime,state) VALUES ( ? , ? , ? , ? , 'RDY' )'''
+        with self.lock:
+            try:
+                self.cs.executemany(cmd, rows)
+                added = self.cs.rowcount
+                self.cs.connection.commit()
+                return added
+            except Exception:
+                self.cs.connection.rollback()
+                raise
+
+    def sync_many(self, rows):
+        """
+            Bring a batch of entries up to date with the source tree, in a single transaction.
+            New files are added, files that changed since they were sent ( or queued ) are
+            made ready again, unchanged ones are left as they are.
+            :rows: iterable of ( path, name, size, mtime, hash ), hash may be None
+            :return: ( number of entries added , number of entries requeued )
+        """
+        rows = [dict(path = path, name = name, size = size, mtime = mtime, hash = hash)
+                for path, name, size, mtime, hash in rows]
+        with self.lock:
+            try:
+                self.cs.executemany(SYNC_ROW, rows)
+                changed = self.cs.rowcount
+                self.cs.executemany(SYNC_HASH, rows)
+                self.cs.executemany('''insert or ignore INTO transfer (path,name,size,mtime,hash,state)
+                                       VALUES ( :path , :name , :size , :mtime , :hash , 'RDY' )''', rows)
+                added = self.cs.rowcount
+                self.cs.connection.commit()
+                return added, changed
+            except Exception:
+                self.cs.connection.rollback()
+                raise
+
     def status(self, reset=False, clear=False, clean=False):
         friendly = dict(DONE = 'Done',FAIL = 'Failed' , RDY = 'Ready' , WRK = 'Processing')
+        recovered = self.recover()
         self.cs.execute('SELECT state,count(*),avg(end_time-start_time) from transfer group by state order by state' )
 
         retval = u'{:10s} |{:23s} |{:20s}\n'.format('State', 'Count', 'Average time in State')
@@ -148,20 +609,38 @@ class DB:
                 retval += '{0:10s} |{1:23s} |{2}\n'.format(str(state), str(count), str(avg))
             ### Done oddball fix
 
+        waiting, = self.cs.execute('''SELECT count(*) FROM transfer WHERE state = 'RDY' AND attempts > 0''').fetchone()
+        if waiting:
+            retval += u'\n{:,} ready entries have failed before and will be retried'.format(waiting)
+        if recovered:
+            retval += u'\n{:,} entries of executors whose lease expired were put back in the queue'.format(recovered)
+
+        # What went wrong with the failed entries, most frequent first
+        self.cs.execute('''SELECT ifnull(error_class, '-'), http_status, count(*), max(last_error)
+                             FROM transfer WHERE state = 'FAIL' GROUP BY 1, 2 ORDER BY 3 DESC''')
+        failures = self.cs.fetchall()
+        if failures:
+            retval += u'\n\n{:20s} |{:7s} |{:12s} |{}\n'.format('Failure', 'Status', 'Count', 'Last error ( for example )')
+            retval += '{:20s} |{:7s} |{:12s} |{}\n'.format('-' * 20, '-' * 7, '-' * 12, '-' * 40)
+            for error_class, http_status, count, example in failures:
+                example = (example or '')[:100]
+                retval += u'{:20s} |{:>7s} |{:12,} |{}\n'.format(error_class, str(http_status or '-'), count, example)
+
         ### See if we need to reset the work queue
-        cmd = None
+        cmds = []
         if reset:
-            cmd = ("""UPDATE transfer
-                        SET state = 'RDY', start_time=strftime('%s','now'), end_time = strftime('%s','now')
-                        WHERE STATE = 'FAIL' or 'STATE' = 'WRK'""")
+            cmds.append("""UPDATE transfer
+                        SET state = 'RDY', start_time=strftime('%s','now'), end_time = strftime('%s','now'),
+                            attempts = 0, not_before = NULL, owner = NULL, lease_until = NULL
+                        WHERE state = 'FAIL' or state = 'WRK'""")
             retval += u'\n\n    Then resetting Failed and Processing values.'
         if clean:
-            cmd = '''DELETE from transfer where state = 'DONE' '''
+            cmds.append('''DELETE from transfer where state = 'DONE' ''')
         if clear:
             # Since sqlite doesn't have a truncate command, just drop the table -- it will be recreated if necessary
-            cmd = u'drop table transfer'
+            cmds = [u'drop table transfer']
         #---
-        if cmd :
+        for cmd in cmds :
             try:
                 self.cs.execute(cmd)
                 self.cs.connection.commit()
@@ -171,3 +650,69 @@ class DB:
 
         # And now return the status
         return retval
+
+
+class DBWriter(Thread):
+    """
+        Apply the updates the workers put on a queue to the database, in batches:  one
+        transaction for every 'batch' updates, or every 'interval' seconds, whichever comes first.
+
+        The queue carries ( row_id , state , T0 , T1 , result ) when a transfer ends, and
+        ( row_id , offset , stamp ) as a chunked upload progresses.  The writer also renews the lease
+        of the rows claimed by the executor, while it runs.
+    """
+    STOP = None
+
+    def __init__(self, db, q, batch = 1000, interval = 0.5):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.db = db
+        self.q = q
+        self.batch = batch
+        self.interval = interval
+        self.written = 0
+
+    def run(self):
+        states, offsets = [], {}
+        deadline = None
+        renewed = time.time()
+        while True:
+            if time.time() - renewed > self.db.lease / 4 :
+                self.db.renew()
+                renewed = time.time()
+            timeout = self.interval if deadline is None else max(0, deadline - time.time())
+            try:
+                entry = self.q.get(timeout = timeout)
+            except Empty:
+                entry = False
+            flushed = None
+            if entry and len(entry) == 1 :
+                flushed, entry = entry[0], False     # see flush()
+            if entry :
+                if len(entry) == 3 :
+                    offsets[entry[0]] = entry[1:]       # only the latest offset of a row matters
+                else :
+                    states.append(entry)
+                if deadline is None :
+                    deadline = time.time() + self.interval
+            if states or offsets :
+                if entry is self.STOP or flushed or len(states) + len(offsets) >= self.batch or time.time() >= deadline :
+                    self.db.update_many(states, [(row_id,) + progress for row_id, progress in offsets.items()])
+                    self.written += len(states)
+                    states, offsets = [], {}
+                    deadline = None
+            if flushed :
+                flushed.set()
+            if entry is self.STOP :
+                return
+
+    def flush(self):
+        """ Wait until everything queued so far is written """
+        done = Event()
+        self.q.put((done,))
+        done.wait()
+
+    def stop(self):
+        """ Write what is left and wait for the writer to finish """
+        self.q.put(self.STOP)
+        self.join()
@@ -0,0 +1,215 @@
+"""
+    Throughput and latency metrics of mput / mput-execute
+
+
+    Drastic Command Line Interface -- multiple put.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import json
+import os
+import sys
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+
+
+METRICS_INTERVAL = 10.0     # seconds between two records of the --metrics file
+PROGRESS_INTERVAL = 1.0     # seconds between two updates of the --progress line
+REMAINING_INTERVAL = 30.0   # seconds between two counts of the work left in the queue
+SAMPLES = 10000             # latencies kept for the percentiles, the most recent ones
+
+
+def percentile(ordered, p):
+    """ Nearest rank percentile of a sorted list, None if it is empty """
+    if not ordered : return None
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+class Metrics(object):
+    """
+        Counters of a transfer run, and the latencies of its most recent PUTs and mkdirs.
+        The workers record into it, a Reporter reads it.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.T0 = time.time()
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self.retries = 0
+        self.mkdirs = 0
+        self.put_latency = deque(maxlen = SAMPLES)
+        self.mkdir_latency = deque(maxlen = SAMPLES)
+        self.gauges = {}
+
+    def put(self, latency, ok, nbytes = 0, retries = 0):
+        """ Record one transfer, retries are the extra tries it took """
+        with self.lock:
+            if ok :
+                self.files += 1
+                self.bytes += nbytes or 0
+            else :
+                self.failed += 1
+            self.retries += retries
+            self.put_latency.append(latency)
+
+    def mkdir(self, latency):
+        """ Record one container creation ( or attempt ) """
+        with self.lock:
+            self.mkdirs += 1
+            self.mkdir_latency.append(latency)
+
+    def gauge(self, name, fn):
+        """ Report fn() as name in every snapshot, the depth of a queue say """
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        """
+        :return: dict  the counters so far, the gauges, and the percentiles of the recent latencies
+        """
+        with self.lock:
+            snap = dict(time = time.time(), files = self.files, failed = self.failed, bytes = self.bytes,
+                        retries = self.retries, mkdirs = self.mkdirs)
+            put_latency = sorted(self.put_latency)
+            mkdir_latency = sorted(self.mkdir_latency)
+        snap['elapsed'] = snap['time'] - self.T0
+        for p in (50, 95, 99) :
+            snap['put_p{}'.format(p)] = percentile(put_latency, p)
+            snap['mkdir_p{}'.format(p)] = percentile(mkdir_latency, p)
+        for name, fn in self.gauges.items() :
+            snap[name] = fn()
+        return snap
+
+
+def prometheus(snap):
+    """ A snapshot in the Prometheus text format, for the node_exporter textfile collector """
+    lines, typed = [], set()
+    def metric(name, kind, value, labels = ''):
+        if value is None : return
+        if name not in typed :
+            typed.add(name)
+            lines.append('# TYPE drastic_mput_{} {}'.format(name, kind))
+        lines.append('drastic_mput_{}{} {}'.format(name, labels, value))
+    for name in ('files', 'failed', 'bytes', 'retries', 'mkdirs') :
+        metric(name + '_total', 'counter', snap[name])
+    for name in ('files_per_sec', 'bytes_per_sec', 'queue_depth', 'writer_backlog', 'remaining_files', 'remaining_bytes') :
+        metric(name, 'gauge', snap.get(name))
+    for kind in ('put', 'mkdir') :
+        for p in (50, 95, 99) :
+            metric('{}_latency_seconds'.format(kind), 'gauge', snap['{}_p{}'.format(kind, p)],
+                   '{{quantile="{}"}}'.format(p / 100.0))
+    return '\n'.join(lines) + '\n'
+
+
+class Reporter(Thread):
+    """
+        Write the metrics to a file every METRICS_INTERVAL seconds, as JSON lines or as a Prometheus
+        textfile ( rewritten in place ), and/or keep a one line progress display up to date on stderr.
+        The ETA comes from the bytes left in the queue, counted by 'remaining' from time to time.
+    """
+
+    def __init__(self, metrics, path = None, format = 'json', progress = False, remaining = None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        if format not in ('json', 'prometheus') :
+            raise ValueError("unknown metrics format <{}>, use 'json' or 'prometheus'".format(format))
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.progress = progress
+        self.remaining = remaining
+        self.stopped = Event()
+        self.last = None            # the snapshot of the last record
+        self.rate = None            # bytes/sec, smoothed, for the ETA
+        self.left = None            # ( files , bytes ) left and the snapshot when the queue was last counted
+
+    def run(self):
+        interval = PROGRESS_INTERVAL if self.progress else METRICS_INTERVAL
+        written = counted = time.time()
+        tick = self.metrics.snapshot()
+        self.count()
+        while not self.stopped.wait(interval) :
+            snap = self.metrics.snapshot()
+            dt = snap['time'] - tick['time']
+            if dt > 0 :
+                rate = (snap['bytes'] - tick['bytes']) / dt
+                self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+            tick = snap
+            if time.time() - counted > REMAINING_INTERVAL :
+                self.count()
+                counted = time.time()
+            if self.progress :
+                self.show(snap)
+            if self.path and time.time() - written >= METRICS_INTERVAL :
+                self.write(snap)
+                written = time.time()
+
+    def count(self):
+        if self.remaining :
+            files, nbytes = self.remaining()
+            self.left = (files, nbytes, self.metrics.snapshot())
+
+    def estimate(self, snap):
+        """ ( files , bytes ) left, allowing for what was sent since the queue was counted """
+        if self.left is None : return None, None
+        files, nbytes, then = self.left
+        return max(0, files - (snap['files'] - then['files'])), max(0, nbytes - (snap['bytes'] - then['bytes']))
+
+    def write(self, snap):
+        snap = dict(snap)
+        if self.last :
+            dt = snap['time'] - self.last['time']
+            snap['files_per_sec'] = (snap['files'] - self.last['files']) / dt if dt > 0 else None
+            snap['bytes_per_sec'] = (snap['bytes'] - self.last['bytes']) / dt if dt > 0 else None
+        snap['remaining_files'], snap['remaining_bytes'] = self.estimate(snap)
+        self.last = snap
+        if self.format == 'json' :
+            with open(self.path, 'a') as fp :
+                fp.write(json.dumps(snap, sort_keys = True) + '\n')
+        else :
+            tmp = self.path + '.tmp'       # the collector must never read a half written file
+            with open(tmp, 'w') as fp :
+                fp.write(prometheus(snap))
+            os.rename(tmp, self.path)
+
+    def show(self, snap):
+        files, nbytes = self.estimate(snap)
+        line = '{:,} files {:,.1f} MB  {:,.1f} files/s  {:,.2f} MB/s'.format(
+            snap['files'], snap['bytes'] / 1e6, snap['files'] / max(snap['elapsed'], 1e-6), (self.rate or 0) / 1e6)
+        if snap['failed'] :
+            line += '  {:,} failed'.format(snap['failed'])
+        if files is not None :
+            line += '  {:,} left'.format(files)
+            if self.rate :
+                eta = int(nbytes / self.rate)
+                line += '  ETA {}:{:02d}:{:02d}'.format(eta // 3600, eta // 60 % 60, eta % 60)
+        sys.stderr.write('\r' + line.ljust(100))
+        sys.stderr.flush()
+
+    def stop(self):
+        """ Stop reporting, after a last record """
+        self.stopped.set()
+        self.join()
+        snap = self.metrics.snapshot()
+        if self.progress :
+            self.show(snap)
+            sys.stderr.write('\n')
+        if self.path :
+            self.write(snap)
+
+
+def metrics_setup(arguments, remaining = None):
+    """
+        Metrics and their Reporter, as asked for by --metrics, --metrics-format and --progress
+    :return: ( Metrics , Reporter ) or ( None , None )
+    """
+    path = arguments.get('--metrics')
+    progress = bool(arguments.get('--progress'))
+    if not path and not progress :
+        return None, None
+    metrics = Metrics()
+    return metrics, Reporter(metrics, path, arguments.get('--metrics-format') or 'json', progress, remaining)
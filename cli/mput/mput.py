@@ -13,7 +13,9 @@ import sys
 import time
 
 from .config import NUM_THREADS
-from .mput_threads import thread_setup, file_putter, file_putter_worker
+from .metrics import metrics_setup
+from .mput_threads import engine_setup, file_putter_worker
+from .scan import scan
 from .utils import _dirmgmt
 
 
@@ -34,8 +36,7 @@ def mput(app, arguments):
             raise ValueError(src)
 
         def reader(dirname):
-            for path, _, files in os.walk(dirname, topdown=True, followlinks=True):
-                for fn in files: yield os.path.abspath(os.path.join(path, fn))
+            for path, fn, _, _ in scan(dirname): yield os.path.abspath(os.path.join(path, fn))
 
         _src = reader(src)
     elif arguments['--read']:
@@ -48,6 +49,9 @@ def mput(app, arguments):
             for l in fp:
                 l = l.strip()
                 if not l: continue
+                if not os.path.isfile(l):
+                    print >> sys.stderr, "skipping -- file does not exist or is not a file : ", l
+                    continue
                 yield os.path.normpath(l)
 
         #### End Function ####
@@ -58,12 +62,21 @@ def mput(app, arguments):
     ####
     #### Now get the list of files and push 'em onto the queue...
     ####
-    client = app.get_client(arguments)
+    client = app.get_client(arguments, pool_size=NUM_THREADS)
     tgtdir = arguments['<tgt-dir-in-repo>']
      ### Set up a directory name cache, so that we don't have to keep going back
-    cache = _dirmgmt()
-
-    q, threads = thread_setup(NUM_THREADS, None,   client , cache = cache )
+    metrics, reporter = metrics_setup(arguments)
+    cache = _dirmgmt(metrics = metrics)
+
+    verify = bool(arguments.get('--verify'))
+    chunk_size = int(arguments.get('--chunk-size') or 0 )
+    window = int(arguments.get('--window') or 0 )
+    q, threads = engine_setup(arguments, client, None, cache = cache ,
+                              verify = verify , chunk_size = chunk_size , window = window , metrics = metrics )
+    for t in threads : t.start()
+    if reporter :
+        metrics.gauge('queue_depth', q.qsize)
+        reporter.start()
 
     ### Instrumentation
     t0 = time.time()
@@ -77,18 +90,16 @@ def mput(app, arguments):
         if n1:
             cache.getdir(n1, client)
 
-        if not os.path.isfile(path):
-            print >> sys.stderr, "skipping -- file does not exist or is not a dir : ", path
-            continue
-
         print "putting ", (path, tgtfile, None)
 
-        q.put(tuple((path, tgtfile, None)))
+        q.put(tuple((path, tgtfile, None, 0, None)))
         if NUM_THREADS == 0:
-            file_putter_worker(q, client,cache)  # forced Serialization for debugging...
+            file_putter_worker(path, tgtfile, client, cache, verify, chunk_size, window)  # forced Serialization for debugging...
 
     if NUM_THREADS > 0:
         q.join()
+    if reporter :
+        reporter.stop()
     #####################
     # Summary
     t2 = time.time()
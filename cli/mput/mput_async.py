@@ -0,0 +1,62 @@
+"""
+
+Drastic Command Line Interface -- multiple put.
+
+    The 'async' engine: instead of a fixed pool of blocking workers, a single dispatcher
+    keeps up to 'inflight' PUTs outstanding, bounded by a semaphore.  Each PUT runs in a
+    short lived thread with a small stack, so hundreds of them cost little more than the
+    sockets they hold; on high latency links the number of requests in flight, not CPU,
+    is what limits the transfer rate.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import threading
+import time
+
+from .config import ASYNC_INFLIGHT
+from .mput_threads import put_crashed, put_entry
+
+STACK_SIZE = 256 * 1024  # Stack of each in-flight PUT, the default is several MB
+
+
+def async_putter(q, client, cnx, cache = None , db_queue = None , inflight = ASYNC_INFLIGHT , **options ) :
+    """
+    Pull entries from the queue, and start a PUT for each one as soon as fewer than
+    'inflight' are outstanding.  Takes the place of file_putter in thread_setup.
+
+    :param q: Queue
+    :param client:  DrasticClient
+    :param cnx: N/A  the status is reported through db_queue
+    :param cache: .utils._dirmgmt
+    :param db_queue: Queue
+    :param inflight: int  maximum number of PUTs outstanding
+    :param options: keyword arguments passed on to put_entry ( verify, ... )
+    :return: N/A
+    """
+    if cnx and not db_queue :
+        raise ValueError("the async engine reports the file status through db_queue only")
+    slots = threading.BoundedSemaphore(inflight)
+
+    def run(entry):
+        T0 = time.time()
+        try:
+            put_entry(entry, client, None, cache, db_queue, **options)
+        except Exception as e:
+            put_crashed(entry, T0, e, db_queue = db_queue)
+        finally:
+            slots.release()
+            q.task_done()
+
+    while True:
+        entry = q.get()
+        slots.acquire()
+        t = threading.Thread(target=run, args=(entry,))
+        t.setDaemon(True)
+        # The stack size is a setting of the process, only the PUT threads get the small one
+        old = threading.stack_size(STACK_SIZE)
+        try:
+            t.start()
+        finally:
+            threading.stack_size(old)
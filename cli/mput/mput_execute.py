@@ -11,76 +11,66 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 import os.path
 
 from .config import NUM_THREADS
-from .db import DB
+from .controller import controller_setup
+from .db import DB, DBWriter, REMOTE_TTL
+from .metrics import metrics_setup
 from .mput_threads import *
-from .utils import _dirmgmt, counter_timer
-from Queue import  Empty
+from .remote import skip_existing, target_dir
+from .utils import _dirmgmt, run_queue
 
 
-def clear_db_queue(q,db) :
-    while True :
-            try:
-                row_id,state,T0,T1 =  q.get(block=False)
-                db.update(row_id,state)
-            except Empty:
-                return None
-
 def mput_execute(app, arguments):
     db = DB(app, arguments)
     tgt_prefix = arguments['<tgt-dir-in-repo>']
-    dir_cache = _dirmgmt( )
+    metrics, reporter = metrics_setup(arguments, remaining = db.remaining)
+    dir_cache = _dirmgmt( metrics = metrics )
     db_queue = Queue(16*1024)
-    client = app.get_client(arguments)
-    q, threads = thread_setup(NUM_THREADS, None if True else db.cnx  ,  client, file_putter, cache = dir_cache , db_queue = db_queue )
+    writer = DBWriter(db, db_queue)         # records the outcome of the transfers, in batches
+    writer.start()
+    client = app.get_client(arguments, pool_size=NUM_THREADS)
+    verify = bool(arguments.get('--verify'))
+    chunk_size = int(arguments.get('--chunk-size') or 0 )
+    window = int(arguments.get('--window') or 0 )
+    controller = controller_setup(arguments)
+    q, threads = engine_setup(arguments, client, None if True else db.cnx , cache = dir_cache , db_queue = db_queue ,
+                              verify = verify , chunk_size = chunk_size , window = window , controller = controller ,
+                              metrics = metrics )
     for t in threads : t.start()
+    if reporter :
+        metrics.gauge('queue_depth', q.qsize)
+        metrics.gauge('writer_backlog', db_queue.qsize)
+        reporter.start()
 
     debug = arguments.get('-D',0)
     debug = int(debug) if isinstance(debug,basestring) and debug.isdigit() else 0
 
-
-    while True:
-        clear_db_queue(db_queue,db)
-
-        thisdir = db.get_and_lock()   ## get another directories worth of files
-        if not thisdir   :
-            break
-        # Start by ensuring there is a container to go into...
-        path = thisdir[0][0]
-
-        tgtdir = os.path.normpath(os.path.join(unicode(tgt_prefix), path.lstrip('/')))
-        ### This is now done in the threads...
-        if False:
-            if not dir_cache.getdir(tgtdir,client) :
-                 print "FAILED to create <{}> or one of its ancestors"
-                 continue
-
-        T0,N = time.time(),0            # instrumentation
-        for path, name, start_time, end_time, row_id in thisdir:
-            N += 1
-            # Queue up the put request to a thread...
-            q.put((os.path.join(path, name),  os.path.join(tgtdir ,name) , row_id))
-
-    # Now wait for all the workers to finish
-
-    N,T0 = q.qsize(),time.time()
-    while True :
-        clear_db_queue(db_queue,db)
-        if q.qsize() < 1 : break
-        else :
-            time.sleep(3)
-            if debug > 1 :
-                N1 = q.qsize()
-                T1 = time.time()
-                print "{} entries left, rate = {:,.2f}/sec".format(N1,(N-N1)/(T1-T0))
-                N,T0 = N1,T1
-
-
-    print 'Queue is empty',q.qsize()
-    ### Clear any remaining DB updates
-    clear_db_queue(db_queue,db)
-
-    q.join()  # suspends until the queue is empty and all the workers have acknowledged completion
-
-    clear_db_queue(db_queue,db)
+    # Leave out what is in the archive already, as found by a listing of each target container
+    if arguments.get('--skip-existing') :
+        T0 = time.time()
+        skipped = skip_existing(db, client, tgt_prefix, float(arguments.get('--cache-ttl') or REMOTE_TTL), NUM_THREADS,
+                                size_only = bool(arguments.get('--size-only')))
+        print "{:,} files in the archive already, skipped in {:.2f} secs".format(skipped, time.time() - T0)
+
+    # Create the target tree first, top-down and a level at a time, so that each
+    # container costs a single mkdir and the PUTs never wait for one
+    tgtdirs = set(target_dir(tgt_prefix, path) for path in db.distinct_paths())
+    T0 = time.time()
+    failed = dir_cache.precreate(tgtdirs, client, NUM_THREADS, top = target_dir(tgt_prefix, ''))
+    if debug > 0 :
+        print "{} containers checked in {:.2f} secs, {} failed".format(len(tgtdirs), time.time() - T0, failed)
+
+    # Claim the files a directory at a time and put them, see run_queue
+    def entries(claim):
+        tgtdir = target_dir(tgt_prefix, claim[0][0])
+        # Its listing, if --skip-existing kept one, misses what is put now
+        db.remote_forget(tgtdir)
+        return [(os.path.join(path, name), os.path.join(tgtdir, name), row_id, bytes_done, stamp)
+                for path, name, start_time, end_time, row_id, bytes_done, stamp in claim]
+    run_queue(db, q, writer, entries, debug, controller)
+
+    ### Write any remaining DB updates
+    writer.stop()
+    if reporter :
+        reporter.stop()
 
     print 'Done'
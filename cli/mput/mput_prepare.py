@@ -1,4 +1,3 @@
-
 """
     DB Wrapping class for the multiple put
 
@@ -9,52 +8,116 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
-import os.path
+import hashlib
+import os
 import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from .config import SCAN_THREADS
 from .db import DB
-from .mput_threads import *
+from .scan import scan
+from .utils import batches
+
+
+BATCH_SIZE = 10000      # rows inserted per transaction
+REPORT_INTERVAL = 30    # seconds between progress lines
+
+
+def walked(tree):
+    """
+        ( path, name, size, mtime ) of every file under tree, from the parallel scanner,
+        which has already stat'ed them.
+    """
+    for dirname, fn, size, mtime in scan(tree) :
+        yield dirname.decode('utf-8'), fn.decode('utf-8'), size, mtime
+
+
+def listed(fp):
+    """
+        ( path, name, size, mtime ) of every existing file named in a file list, one path per line.
+    """
+    for path in fp :
+        path = path.rstrip('\r\n')
+        if not path : continue
+        try :
+            st = os.stat(path)
+        except OSError :
+            print >>sys.stderr,"skipping -- file does not exist : ",path
+            continue
+        p1, n1 = os.path.split(os.path.abspath(path))   # abspath normalizes, avoiding naive duplication
+        yield p1.decode('utf-8'), n1.decode('utf-8'), st.st_size, st.st_mtime
+
+
+def md5sum(path, blocksize = 1024 * 1024):
+    """
+        Hex md5 of a file, None if it cannot be read.
+    """
+    h = hashlib.md5()
+    try :
+        with open(path, 'rb') as fp :
+            for block in iter(lambda: fp.read(blocksize), b''):
+                h.update(block)
+    except (IOError, OSError) as e :
+        print >>sys.stderr,"cannot checksum -- {}".format(e)
+        return None
+    return h.hexdigest()
+
+
+def hashed(row):
+    path, name, size, mtime = row
+    return path, name, size, mtime, md5sum(os.path.join(path, name))
 
 
 def mput_prepare(app, arguments):
     db = DB(app, arguments)
 
-    ### Instrumentation
-    t0 = time.time()
-    t1 = t0
-    ctr = 0
-    ####################
     if arguments['--walk']:
-        tree = arguments['<file-list>']
+        tree = arguments['<source-dir>']
         if '~' in tree : tree = os.path.expanduser(tree)
         tree = os.path.normpath(tree)
         if not tree or not os.path.isdir(tree):
             raise ValueError("can't find the tree to walk <{}>".format(tree))
+        rows = walked(tree)
+    elif arguments['<file-list>'] == '-' :
+        rows = listed(sys.stdin)
+    else :
+        rows = listed(open(arguments['<file-list>'],'rU'))
+
+    sync = arguments.get('--sync')
+    pool = ThreadPool(SCAN_THREADS) if arguments.get('--checksum') else None   # hashlib releases the GIL
 
-        for dirname,_,files in os.walk(tree,topdown=True,followlinks=True) :
-            for fn in files :
-                ctr += 1
-                db.insert(os.path.normpath(os.path.join(dirname, fn)).decode('utf-8'))
+    ### Instrumentation
+    t0 = time.time()
+    t1 = t0
+    ctr = 0
+    added = 0
+    changed = 0
+    last = 0
+    ####################
+    with db.bulk_load():
+        for batch in batches(rows, BATCH_SIZE):
+            if sync :
+                if pool : batch = pool.map(hashed, batch)
+                else : batch = [row + (None,) for row in batch]
+                n, c = db.sync_many(batch)
+                added += n
+                changed += c
+            else :
+                added += db.insert_many(batch)
+            ctr += len(batch)
             t2 = time.time()
-            if ( t2 - t1 ) > 30 :
-                print '{0:,} registered in {1:.2f} secs -- {2}/sec'.format(ctr, (t2-t1), ctr / (t2 - t0))
+            if ( t2 - t1 ) > REPORT_INTERVAL :
+                print '{0:,} registered in {1:.2f} secs -- {2:,.0f}/sec now, {3:,.0f}/sec overall'.format(
+                    ctr, (t2-t0), (ctr - last) / (t2 - t1), ctr / (t2 - t0))
                 t1 = t2
-    ####################
-    elif arguments['--read'] :
-        if arguments['<file-list>'] == '-' : fp = sys.stdin
-        else : fp = open(arguments['<file-list>'],'rU')
-        for path in fp :
-            if not os.path.exists(path) :
-                print >>sys.stderr,"skipping -- file does not exist : ",path
-                continue
-            ctr += 1
-            db.insert(os.path.abspath( path).decode('utf-8'))
-            if ctr% 5000 :
-                t2 = time.time()
-                if ( t2 - t1 ) > 30 :
-                    print '{0:,} registered in {1:.2f} secs -- {2:.2f}/sec'.format(ctr, (t2-t1), ctr / (t2 - t0))
-                    t1 = t2
+                last = ctr
 
     #####################
-    # Summary
+    # Summary ( includes building the deferred indexes )
     t2 = time.time()
-    print '{0:,} registered in {1:.2f} secs -- {2:.2f}/sec'.format(ctr, (t2-t1), ctr / (t2 - t0))
+    if pool : pool.close()
+    if sync :
+        print '{0:,} registered ( {1:,} new , {2:,} changed ) in {3:.2f} secs -- {4:,.0f}/sec'.format(ctr, added, changed, (t2-t0), ctr / max(t2 - t0, 1e-6))
+    else :
+        print '{0:,} registered ( {1:,} new ) in {2:.2f} secs -- {3:,.0f}/sec'.format(ctr, added, (t2-t0), ctr / max(t2 - t0, 1e-6))
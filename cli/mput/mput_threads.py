@@ -7,18 +7,24 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
 import sqlite3
+import sys
 import time
 from Queue import Queue
 from threading import Thread
 
 import os.path
-from requests import ConnectionError
+
+from cli.client import CHUNK_WINDOW
+from .config import ASYNC_INFLIGHT, NUM_THREADS
+from .db import RECORD_STATE, connect, record
+from .utils import failure, printable, retrying
 
 # Start
 # We have two functions, the outer one is just to manage the status of the operation in the database
 # the child function ( the worker ) actually puts the file
 #
-def file_putter(q, client, cnx, cache = None , db_queue = None  ) :
+def file_putter(q, client, cnx, cache = None , db_queue = None , verify = False , chunk_size = None , window = None ,
+                controller = None , metrics = None ) :
     """
     Pull local (source) file and remote ( target ) object paths and send them, and then
     update the database that tracks the files....
@@ -28,46 +34,131 @@ def file_putter(q, client, cnx, cache = None , db_queue = None  ) :
     :param cnx: sqlite3.Connection  a database connection to update the file status on completion
     :param cache: .utils._dirmgmt
     :param logger_queue: Queue
+    :param verify: bool  read each object back once it is written
+    :param chunk_size: int  send files larger than this in ranges of this many bytes
+    :param window: int  number of ranges of one file in flight at once
+    :param controller: .controller.ConcurrencyController  decides how many workers may put at once
+    :param metrics: .metrics.Metrics  records every transfer
     :return: N/A
     """
     ### Set everything up ... primarily database connection
-    _stmt1 = '''UPDATE transfer SET state = ? ,start_time=? , end_time = ? Where row_id = ?'''
     cs = None
     if cnx :
         if isinstance(cnx,basestring) :
-            cnx = sqlite3.connect(cnx)
+            cnx = connect(cnx)
         if not isinstance(cnx,sqlite3.Connection) :
             raise ValueError("don't know what to do with {} for database connection".format(cnx))
         cs = cnx.cursor()
     ### Now loop on the queue entry ... which will continue until the parent thread 'joins'
     while True:
-        src, target, row_id = q.get()
-        T0 = time.time()
-        ret = file_putter_worker(src,target  , client,   cache =  cache )
-        T1 = time.time()
-
-        q.task_done()
-        if ret and ret['ok'] : status = 'DONE'
-        else :
-            status = 'FAIL'
-            if ret : print ret['msg']
-        if db_queue :
-            db_queue.put((row_id,status,T0,T1))
-        elif cs :
-            try:
-                cs.execute(_stmt1, (status, T0, T1, row_id))
-                cs.connection.commit()
-            except sqlite3.OperationalError as e :
-                pass
-
-
-def file_putter_worker(src, target , client, cache = None ):
+        entry = q.get()
+        try :
+            if controller :
+                controller.acquire()
+            T0 = time.time()
+            ret = {'ok' : False}
+            try :
+                ret = put_entry(entry, client, cs, cache, db_queue, verify = verify , chunk_size = chunk_size ,
+                                window = window , metrics = metrics )
+            except Exception as e :
+                # The worker carries on: a dead one would leave q.join() waiting forever
+                ret = put_crashed(entry, T0, e, cs, db_queue)
+            finally :
+                # Give the slot back whatever happened, or acquire() ends up waiting forever
+                if controller :
+                    controller.release(time.time() - T0, ret['ok'], ret.get('status'))
+        finally :
+            q.task_done()
+
+
+def put_crashed(entry, T0, exc, cs = None , db_queue = None ) :
+    """
+    Record as failed the entry of a put that raised, rather than leave its row claimed, with its
+    lease renewed, until the executor exits.
+
+    :param entry: tuple  see put_entry
+    :param T0: float  when the put started
+    :param exc: Exception  what it raised
+    :return: dict  a failure(), see .utils
+    """
+    ret = failure(u'failed to put {} -- {} / {}'.format(entry[0], type(exc).__name__, exc), exc = exc)
+    print >> sys.stderr, printable(ret['msg'])
+    row_id = entry[2]
+    if row_id is None :
+        return ret
+    if db_queue :
+        db_queue.put((row_id, 'FAIL', T0, time.time(), ret))
+    elif cs :
+        try:
+            cs.execute(RECORD_STATE, record(row_id, 'FAIL', T0, time.time(), ret))
+            cs.connection.commit()
+        except sqlite3.OperationalError as e :
+            print >> sys.stderr, 'failed to record FAIL for {} -- {}'.format(printable(entry[0]), e)
+    return ret
+
+
+def put_entry(entry, client, cs, cache = None , db_queue = None , verify = False , chunk_size = None , window = None ,
+              metrics = None ) :
+    """
+    Put one queue entry, and then report its status to the database.
+
+    :param entry: tuple  ( source file , target object , row_id , bytes already acknowledged , ( size , mtime )
+                         of the file when they were )
+    :param client:  DrasticClient
+    :param cs: sqlite3.Cursor  used to update the file status when there is no db_queue
+    :param cache: .utils._dirmgmt
+    :param db_queue: Queue
+    :param metrics: .metrics.Metrics
+    :return: dict  the result of file_putter_worker, with the bytes acknowledged in 'bytes'
+    """
+    src, target, row_id, offset, stamp = entry
+    acked = [offset or 0, stamp]
+    def progress(done, stamp):
+        # Chunked uploads report the acknowledged offset so they can be resumed, by a
+        # retry here or by a later claim of the row, as long as the file is unchanged
+        acked[:] = done, stamp
+        if db_queue and row_id is not None :
+            db_queue.put((row_id, done, stamp))
+    T0 = time.time()
+    # Transient failures are retried at once, resuming a chunked upload where it stopped
+    ret = retrying(lambda: file_putter_worker(src,target  , client,   cache =  cache , verify = verify ,
+                                              chunk_size = chunk_size , window = window , offset = acked[0] ,
+                                              stamp = acked[1] , progress = progress ))
+    T1 = time.time()
+    ret.setdefault('bytes', acked[0])
+    if metrics :
+        metrics.put(T1 - T0, ret['ok'], ret['bytes'], ret['tries'] - 1)
+
+    if ret['ok'] : status = 'DONE'
+    else :
+        status = 'FAIL'
+        print ret['msg']
+    if db_queue :
+        db_queue.put((row_id,status,T0,T1,ret))
+    elif cs :
+        try:
+            cs.execute(RECORD_STATE, record(row_id, status, T0, T1, ret))
+            cs.connection.commit()
+        except sqlite3.OperationalError as e :
+            # Still locked after the busy timeout, the row stays in WRK
+            print >> sys.stderr, 'failed to record {} for {} -- {}'.format(status, src, e)
+    return ret
+
+
+def file_putter_worker(src, target , client, cache = None , verify = False ,
+                       chunk_size = None , window = None , offset = 0 , stamp = None , progress = None ):
     """
     :param src: basestring
     :param target: basestring
     :param client:  DrasticClient
     :param cache: .util._dirmgmt
-    :return: N/A
+    :param verify: bool  read the object back once it is written, otherwise trust the PUT response
+    :param chunk_size: int  send files larger than this in ranges of this many bytes
+    :param window: int  number of ranges in flight at once
+    :param offset: int  bytes already acknowledged by a previous attempt
+    :param stamp: tuple  ( size , mtime ) of the file when they were, see DrasticClient.put_chunked
+    :param progress: callable  called with the acknowledged offset of a chunked upload
+    :return: dict  { 'ok' : True , 'bytes' } or a failure(), see .utils
     """
 
     ### Handle directory creation here...
@@ -76,22 +167,67 @@ def file_putter_worker(src, target , client, cache = None ):
     ###
     if cache is not None :                  # Cache may be empty, or it may be not present, so be precise.
         tgtdir,nm = os.path.split(target)
-        if not cache.getdir(tgtdir, client):
-            return {'ok': False, 'msg': 'Failed to Create {} or one of its parents'.format(tgtdir)}
+        try :
+            made = cache.getdir(tgtdir, client)
+        except Exception as e :
+            return failure(u'Failed to Create {} or one of its parents'.format(tgtdir), exc = e)
+        if not made :
+            return failure('Failed to Create {} or one of its parents'.format(tgtdir), transient = True)
 
-    with open(src, 'rb') as fh:
+    try:
+        fh = open(src, 'rb')
+    except (IOError, OSError) as e:
+        return failure(u'cannot read {} [{}]'.format(src, e))
+    with fh:
         try:
-            res = client.put(target, fh)
+            if chunk_size :
+                res = client.put_chunked(target, fh, chunk_size = chunk_size , window = window or CHUNK_WINDOW ,
+                                         offset = offset or 0 , stamp = stamp , progress = progress , verify = verify )
+            else :
+                res = client.put(target, fh, verify = verify)
             if res.ok() :
                 print 'put ',str(target)
-                return {'ok' : True }
-        except ConnectionError as e:
-            return {'ok': False, 'msg': 'Connection Error'}
+                return {'ok' : True , 'bytes' : os.fstat(fh.fileno()).st_size }
+            return failure(u'failed to put {} to {} [{}]'.format(src, target, res.msg()), status = res.code())
         except Exception as e:
-            return {'ok': False, 'msg': u'failed to put {} to {} [{} / {}]'.format(src, target,type(e), e)}
+            return failure(u'failed to put {} to {} [{} / {}]'.format(src, target, type(e).__name__, e), exc = e)
+
+
+def engine_setup(arguments, client, cnx, cache = None , db_queue = None , **options ):
+    """
+    Set up the workers of the engine picked with --engine
+
+        threads -- NUM_THREADS blocking workers, each with one PUT in flight, or as many
+                   as the ConcurrencyController passed as 'controller' allows
+        async   -- one dispatcher keeping up to --inflight PUTs in flight ( see .mput_async )
+
+    :param arguments: docopt arguments
+    :param client: DrasticClient
+    :param cnx: sqlite3.Connection
+    :param cache:  _dirmgmt
+    :param db_queue: Queue
+    :param options: keyword arguments passed on to every worker ( verify, ... )
+    :return: [ queue , [threads]  ]
+    """
+    engine = arguments.get('--engine') or 'threads'
+    controller = options.get('controller')
+    if engine == 'threads' and controller :
+        if not arguments.get('--pool-size') :
+            client.set_pool_size(controller.maximum)
+        return thread_setup(controller.maximum, cnx, client, file_putter, cache, db_queue, **options)
+    elif engine == 'threads' :
+        return thread_setup(NUM_THREADS, cnx, client, file_putter, cache, db_queue, **options)
+    elif engine == 'async' :
+        from .mput_async import async_putter
+        options.pop('controller', None)     # the number of PUTs in flight is set by --inflight
+        inflight = int(arguments.get('--inflight') or ASYNC_INFLIGHT)
+        if not arguments.get('--pool-size') :
+            client.set_pool_size(inflight)
+        return thread_setup(1, cnx, client, async_putter, cache, db_queue, inflight = inflight, **options)
+    raise ValueError("unknown engine <{}>, use 'threads' or 'async'".format(engine))
 
 
-def thread_setup(N, cnx, client, target=file_putter , cache = None , db_queue = None  ):
+def thread_setup(N, cnx, client, target=file_putter , cache = None , db_queue = None , **options ):
     """
 
     :param N: int                           -- Number of worker threads...
@@ -99,12 +235,13 @@ def thread_setup(N, cnx, client, target=file_putter , cache = None , db_queue =
     :param client: DrasticClient             -- the CDMI client object ... it appears to be thread safe,so no point in replicating it
     :param target:                          -- function
     :param cache:  _dirmgmt                 -- Cache of found filenames...
+    :param options:                         -- keyword arguments passed on to every worker ( verify, ... )
     :return: [ queue , [threads]  ]
     """
     q = Queue(4096)
     threads = []
     for k in range(N):
-        t = Thread(target=target, args=(q, client, cnx ,  cache , db_queue ))
+        t = Thread(target=target, args=(q, client, cnx ,  cache , db_queue ), kwargs=options)
         t.setDaemon(True)
         #t.start()
         threads.append(t)
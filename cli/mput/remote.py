@@ -0,0 +1,113 @@
+"""
+    Skip the files already in the archive
+
+
+    Drastic Command Line Interface -- multiple put.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import os
+from multiprocessing.pool import ThreadPool
+
+from cli.errors import HTTPError
+
+from .db import REMOTE_TTL
+from .mput_prepare import md5sum
+
+
+HASH_METADATA = ('cdmi_checksum', 'checksum')  # metadata that may hold the md5 of an object, first found wins
+
+
+def target_dir(tgt_prefix, path):
+    """ The container a source directory is put into """
+    return os.path.normpath(os.path.join(unicode(tgt_prefix), path.lstrip('/')))
+
+
+def list_container(client, container):
+    """
+    :return: [ name ] the data objects in a container, None if it cannot be listed ( it doesn't exist, say )
+    """
+    try :
+        return [name for name in client.ls_iter(container) if not name.endswith('/')]
+    except HTTPError :
+        return None
+
+
+def remote_object(client, path):
+    """
+    :return: ( size , hash ) of a data object, hash is None unless the archive keeps one, None if it is gone
+    """
+    res = client.get_metadata(path)
+    if not res.ok():
+        return None
+    metadata = res.json()
+    size = metadata.get('cdmi_size')
+    hash = next((metadata[k] for k in HASH_METADATA if metadata.get(k)), None)
+    return (int(size) if size is not None else None), (hash.lower() if hash else None)
+
+
+def skip_directory(db, client, path, container, ttl, size_only = False):
+    """
+        Mark DONE the ready files of a source directory that are in the archive already.
+
+        The container is listed once, the listing is kept in the queue for ttl seconds.  The
+        size and md5 of an object are only fetched for a file of the same name, and kept too.
+        A file is present when both its size and its md5 match ( the file is read when the
+        queue has no md5 ), an object the archive keeps no md5 for is sent again unless
+        size_only is set.
+    :param size_only: bool  take an object of the same size for the file when there is no md5 to compare
+    :return: int  number of files skipped
+    """
+    rows = db.ready_files(path)
+    if not rows :
+        return 0
+    children = db.remote_listing(container, ttl)
+    if children is None :
+        names = list_container(client, container)
+        if names is None :          # nothing there yet, nothing worth remembering
+            return 0
+        children = dict((name, (None, None)) for name in names)
+        db.remote_store(container, children = children)
+    found, present = [], []
+    for row_id, name, size, hash in rows :
+        if name not in children :
+            continue
+        remote = children[name]
+        if remote[0] is None :
+            remote = remote_object(client, os.path.join(container, name))
+            if remote is None :
+                continue
+            found.append((name,) + remote)
+        rsize, rhash = remote
+        if rsize != size :
+            continue
+        if rhash :
+            hash = hash or md5sum(os.path.join(path, name))
+            if hash != rhash :
+                continue
+        elif not size_only :
+            continue
+        present.append((row_id, hash))
+    db.remote_store(container, objects = found)
+    return db.mark_present(present)
+
+
+def skip_existing(db, client, tgt_prefix, ttl = REMOTE_TTL, workers = 8, size_only = False):
+    """
+        Mark DONE every ready file of the queue already in the archive, the directories in parallel.
+    :param size_only: bool  see skip_directory
+    :return: int  number of files skipped
+    """
+    def skip(path):
+        try :
+            return skip_directory(db, client, path, target_dir(tgt_prefix, path), ttl, size_only)
+        except Exception as e :     # the files are simply sent
+            print "cannot check {} in the archive [{}]".format(path, e)
+            return 0
+    pool = ThreadPool(workers)
+    try :
+        return sum(pool.map(skip, db.distinct_paths()))
+    finally :
+        pool.close()
@@ -0,0 +1,117 @@
+"""
+    Parallel scanner of a local source tree
+
+
+    Drastic Command Line Interface -- multiple put.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import os
+import stat
+import sys
+from Queue import Queue
+from threading import Lock, Thread
+
+try:
+    from os import scandir              # python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir     # the backport, if installed
+    except ImportError:
+        scandir = None                  # fall back to listdir + stat
+
+from .config import SCAN_THREADS
+
+
+def _entries(dirname):
+    """
+        ( name, is_dir, stat ) of every entry of a directory, following symlinks.
+        scandir tells directories from files without a system call, only the stat
+        itself is needed, for the size and mtime of a file or the identity of a directory.
+        Entries that vanish or are broken symlinks are reported and left out.
+    """
+    if scandir is not None:
+        for entry in scandir(dirname):
+            try:
+                yield entry.name, entry.is_dir(), entry.stat()
+            except OSError as e:
+                print >> sys.stderr, "skipping -- {}".format(e)
+    else:
+        for name in os.listdir(dirname):
+            try:
+                st = os.stat(os.path.join(dirname, name))
+            except OSError as e:
+                print >> sys.stderr, "skipping -- {}".format(e)
+                continue
+            yield name, stat.S_ISDIR(st.st_mode), st
+
+
+def scan(top, workers=SCAN_THREADS):
+    """
+        Walk a tree with a pool of directory listing threads, like os.walk(followlinks=True)
+        but with many directories listed at once, which is what high latency file systems
+        ( NFS, Lustre ) need.
+
+        Each directory is listed once, it is identified by ( st_dev, st_ino ) so a symlink
+        loop ( or a second link to the same directory ) is not followed again.  Only regular
+        files are reported, in no particular order.
+
+    :param top: basestring  the directory to walk
+    :param workers: int  number of listing threads
+    :return: generator of ( dirname, name, size, mtime )
+    """
+    top = os.path.normpath(top)
+    st = os.stat(top)
+    seen = set([(st.st_dev, st.st_ino)])
+    seen_lock = Lock()
+
+    dirs = Queue()
+    out = Queue(maxsize=workers * 4)       # back pressure, listings wait for the consumer
+    DONE = object()
+
+    def lister():
+        while True:
+            dirname = dirs.get()
+            if dirname is None:
+                return
+            try:
+                files = []
+                for name, is_dir, st in _entries(dirname):
+                    if is_dir:
+                        with seen_lock:
+                            key = (st.st_dev, st.st_ino)
+                            if key in seen: continue
+                            seen.add(key)
+                        dirs.put(os.path.join(dirname, name))
+                    elif stat.S_ISREG(st.st_mode):
+                        files.append((dirname, name, st.st_size, st.st_mtime))
+                if files:
+                    out.put(files)
+            except OSError as e:
+                print >> sys.stderr, "cannot list -- {}".format(e)
+            finally:
+                dirs.task_done()
+
+    listers = [Thread(target=lister) for _ in range(workers)]
+
+    def finisher():
+        dirs.join()                 # every directory listed, and no more queued
+        for _ in listers:
+            dirs.put(None)
+        for t in listers:
+            t.join()
+        out.put(DONE)
+
+    dirs.put(top)
+    for t in listers + [Thread(target=finisher)]:
+        t.daemon = True
+        t.start()
+
+    while True:
+        files = out.get()
+        if files is DONE:
+            return
+        for f in files:
+            yield f
@@ -7,58 +7,256 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
 import os
+import socket
 import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock
+
+from requests.exceptions import ConnectionError, ChunkedEncodingError, Timeout
+
+from .config import RETRIES, RETRY_DELAY
+from .db import CLAIM_ROWS
 
 ### Pull paths from the database and put 'em ...
 
+# Failures worth trying again: the server or the network had a problem, not the request
+TRANSIENT_STATUS = (408, 429)           # ... and every 5xx
+TRANSIENT_ERRORS = (ConnectionError, ChunkedEncodingError, Timeout, socket.error)
+
+
+def printable(s):
+    """ What print can write to a pipe or a file too, where python 2 encodes unicode as ascii """
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+
+def failure(msg, status = None, exc = None, **extra):
+    """
+        The result of a failed transfer, classified as transient ( 5xx, 408, 429, timeouts,
+        connection resets ... ) or permanent ( any other status, 403 or 409 say, or a local error ).
+    :param msg: basestring  what went wrong
+    :param status: int  HTTP status of the response, if there was one
+    :param exc: Exception  what was raised, if anything
+    :return: dict  { 'ok' : False , 'msg' , 'status' , 'error' , 'transient' , ... }
+    """
+    if exc is not None :
+        error = type(exc).__name__
+        transient = isinstance(exc, TRANSIENT_ERRORS)
+    else :
+        error = 'HTTP' if status else 'Error'
+        transient = bool(status) and (status >= 500 or status in TRANSIENT_STATUS)
+    ret = {'ok': False, 'msg': msg, 'status': status, 'error': error, 'transient': transient}
+    ret.update(extra)
+    return ret
+
+
+def retrying(attempt, retries = RETRIES, delay = RETRY_DELAY):
+    """
+        Call attempt() until it succeeds, fails for good ( see failure() ), or has been retried
+        'retries' times, waiting delay, 2 * delay ... between the calls.
+    :return: dict  the result of the last call, with the number of calls in 'tries'
+    """
+    for n in range(retries + 1):
+        ret = attempt()
+        if ret['ok'] or not ret.get('transient') or n == retries :
+            break
+        time.sleep(delay * 2 ** n)
+    ret['tries'] = n + 1
+    return ret
+
+
+def batches(iterable, size):
+    """
+        Split an iterable into lists of at most size items, without reading it all first.
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch: return
+        yield batch
+
+
 class counter_timer:
-    def __init__(self,label, enabled = True  ):
+    """
+        Time a block, and pass the elapsed time to observe ( a .metrics.Metrics method say ),
+        or print it as a TRACE line on stderr.
+    """
+    def __init__(self,label, enabled = True , observe = None ):
         self.label = label
         self.enabled = enabled
+        self.observe = observe
     def __enter__(self):
         if not self.enabled : return False
         self.T0 = time.time()
     def __exit__(self, exc_type, exc_value, traceback ):
-        if not self.enabled : return True
+        if not self.enabled : return
+        if self.observe :
+            self.observe(time.time() - self.T0)
+            return
         from sys import stderr
         print >> stderr,"TRACE: {} : elapsed : {:0,.3f}s   ". format(self.label, time.time() - self.T0  )
         return
 
 class _dirmgmt(set):
-    def __init__(self, *args ):
-        from threading import Lock
+    """
+        The containers known to exist in the archive, and the creation of the missing ones.
+
+        Each container is created once: threads that need one whose creation is under way
+        wait for it rather than sending their own mkdir ( single flight ).  The leaf is tried
+        first, as its parent usually exists; if that fails the parent is made the same way,
+        and then the leaf again.  A container that exists proves that all its ancestors do,
+        so they are all remembered.
+    """
+    def __init__(self, *args , **kwargs ):
         set.__init__(self, *args )
         self.lock =   Lock()
+        self.inflight = {}                      # path -> Event, set once its creation is over
+        self.metrics = kwargs.get('metrics')     # .metrics.Metrics , times the mkdirs
 
     def  getdir(self,tgtdir, client) :
         """
+            Make sure a container exists, creating it and its missing ancestors if need be.
 
         :param tgtdir: basestring
         :param client: DrasticClient
-        :return:
+        :return: bool  False if it could not be created
         """
+        tgtdir = tgtdir.rstrip('/') or '/'
+        if tgtdir in self or tgtdir == '/' : return True
+        with self.lock :
+            if tgtdir in self : return True
+            event = self.inflight.get(tgtdir)
+            leader = event is None
+            if leader :
+                event = self.inflight[tgtdir] = Event()
+        if not leader :
+            event.wait()                        # someone else is creating it
+            return tgtdir in self
 
-        if tgtdir in self : return True
-        dirs = [  tgtdir[:] , ]             # initialize the directory stack
-        ### Then walk up the directory stack as far as necessary...
-        while dirs :
-            with counter_timer('mkdir_primitive') :
-                res = client.mkdir(dirs[-1])
-                if res.ok() :
-                    tdir = dirs.pop()
-                    # Update the cache -- safely
-                    self.lock.acquire()
-                    self.add(tdir)
-                    self.lock.release()
-                    continue
-
-            #### Go here if the mkdir failed... push the parent onto the stack and retry.
-
-            tdir,_ = os.path.split( dirs[-1] )
-            if tdir != '/' :
-                dirs.append(tdir)
-            else :
-                print "can't make directory {} or some of its parents".format(tgtdir)
-                return False
+        ok = False
+        try :
+            ok = self._make(tgtdir, client)
+        finally :
+            with self.lock :
+                if ok : self.confirm(tgtdir)
+                del self.inflight[tgtdir]
+            event.set()
+        return ok
+
+    def confirm(self, tgtdir):
+        """ Remember a container and all its ancestors, the lock must be held """
+        while tgtdir not in self and tgtdir != '/' :
+            self.add(tgtdir)
+            tgtdir = os.path.dirname(tgtdir)
 
+    def _mkdir(self, tgtdir, client):
+        with counter_timer('mkdir_primitive', enabled = self.metrics is not None ,
+                           observe = self.metrics and self.metrics.mkdir ) :
+            return client.mkdir(tgtdir).ok()
+
+    def _make(self, tgtdir, client):
+        if self._mkdir(tgtdir, client) :
+            return True
+        parent = os.path.dirname(tgtdir)
+        if parent == '/' :
+            print "can't make directory {} or some of its parents".format(tgtdir)
+            return False
+        if not self.getdir(parent, client) :
+            return False
+        if not self._mkdir(tgtdir, client) :
+            print "can't make directory {}".format(tgtdir)
+            return False
         return True
+
+    def precreate(self, dirs, client, workers, top = None):
+        """
+            Create a whole tree of containers before the files are put: top-down, one level at a
+            time, the containers of a level in parallel.  Their parents being there already,
+            each of them costs a single mkdir.
+
+        :param dirs: iterable of container paths
+        :param client: DrasticClient
+        :param workers: int  mkdirs in flight at once
+        :param top: basestring  the containers between 'dirs' and this one are created too ( all
+                    of them up to '/' by default )
+        :return: int  number of containers that could not be created
+        """
+        top = (top.rstrip('/') or '/') if top else '/'
+        levels = {}
+        for d in dirs :
+            d = d.rstrip('/') or '/'
+            # With the ancestors that hold no file, or a level would wait on the mkdirs of its parents
+            while d not in self and d not in ('/', '') :
+                levels.setdefault(d.count('/'), set()).add(d)
+                if d == top :
+                    break
+                d = os.path.dirname(d)
+        if not levels :
+            return 0
+        def make(d):
+            try :
+                return self.getdir(d, client)
+            except Exception as e :         # left to the PUTs of its files, which retry
+                print "can't make directory {} [{}]".format(d, e)
+                return False
+        pool = ThreadPool(workers)
+        try :
+            failed = 0
+            for depth in sorted(levels) :
+                failed += pool.map(make, levels[depth]).count(False)
+            return failed
+        finally :
+            pool.close()
+
+
+def run_queue(db, q, writer, entries, debug = 0, controller = None):
+    """
+        Claim and transfer until nothing is ready, then wait for the failed entries that
+        are due for a retry, if any.  Shared by mput-execute and mget-execute.
+
+    :param db: .db.DB  the work queue
+    :param q: Queue  of the workers
+    :param writer: .db.DBWriter  records the outcome of the transfers
+    :param entries: callable  the entries to put on q for a claim, the rows of one directory
+    :param debug: int  -D level, 2 prints the queue depth and the rate every 3 seconds
+    :param controller: .controller.ConcurrencyController  printed with them, if any
+    """
+    reported = time.time()
+    while True:
+        while True:
+            # Only claim more once most of the last claim is under way, the rest of the
+            # queue is left for other executors working on the same label
+            while q.qsize() > CLAIM_ROWS // 4 :
+                time.sleep(0.1)
+                if debug > 1 and time.time() - reported >= 3 :
+                    print "{} entries queued {}".format(q.qsize(), controller or '')
+                    reported = time.time()
+            claim = db.get_and_lock()   ## get another directories worth of entries
+            if not claim :
+                break
+            for entry in entries(claim) :
+                q.put(entry)
+
+        # Now wait for all the workers to finish
+        N,T0 = q.qsize(),time.time()
+        while True :
+            if q.qsize() < 1 : break
+            else :
+                time.sleep(3)
+                if debug > 1 :
+                    N1 = q.qsize()
+                    T1 = time.time()
+                    print "{} entries left, rate = {:,.2f}/sec {}".format(N1,(N-N1)/(T1-T0), controller or '')
+                    N,T0 = N1,T1
+
+        print 'Queue is empty',q.qsize()
+
+        q.join()  # suspends until the queue is empty and all the workers have acknowledged completion
+
+        writer.flush()
+        ready = db.next_ready()
+        if ready is None :
+            break
+        if debug > 0 :
+            print 'waiting {:.0f} secs for the next retry'.format(max(0, ready - time.time()))
+        time.sleep(max(0, ready - time.time()))
@@ -0,0 +1,160 @@
+"""Tracing of the HTTP requests of a DrasticClient.
+
+A tracer is any callable taking one record per request, a dict with::
+
+    time       when the request started (epoch seconds)
+    method     GET, PUT, ...
+    url        the url requested
+    status     the HTTP status, None if no response came back
+    sent       bytes of the request body (Content-Length), None if unknown
+    received   bytes of the response body, None if unknown (streamed)
+    connect    seconds spent opening a connection (DNS lookup, TCP and TLS
+               handshakes), 0 when a kept-alive one was reused
+    ttfb       seconds from sending the request to the response headers,
+               connect included
+    total      seconds spent in the request, the body of a streamed
+               response is read later by the caller
+    error      name of the exception raised, if any
+
+:class:`JSONLSink`, :class:`RingBuffer` or a plain function can all be used,
+see :meth:`cli.client.DrasticClient.set_tracer`.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                  HTTPSConnection)
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                      HTTPSConnectionPool)
+
+
+# Connections are opened by the thread sending the request, the time it
+# took is left here for traced() to pick up
+_local = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        t0 = time.time()
+        try:
+            HTTPConnection.connect(self)
+        finally:
+            _local.connect = getattr(_local, 'connect', 0.0) + time.time() - t0
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        t0 = time.time()
+        try:
+            HTTPSConnection.connect(self)
+        finally:
+            _local.connect = getattr(_local, 'connect', 0.0) + time.time() - t0
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TracingAdapter(HTTPAdapter):
+    """An ``HTTPAdapter`` whose connections time how long they take to open.
+
+    Only mounted while a tracer is set, untraced clients keep the plain
+    urllib3 classes.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+def traced(session, tracer, method, url, **kwargs):
+    """Send a request through ``session`` and pass its record to ``tracer``.
+
+    :arg session: requests.Session
+    :arg tracer: callable, called with the record of the request
+    :returns: the requests.Response, exceptions are raised after being
+      recorded
+
+    """
+    _local.connect = 0.0
+    record = {'time': time.time(), 'method': method, 'url': url,
+              'status': None, 'sent': None, 'received': None,
+              'connect': None, 'ttfb': None, 'error': None}
+    t0 = time.time()
+    try:
+        res = session.request(method, url, **kwargs)
+    except Exception as e:
+        record['total'] = time.time() - t0
+        record['connect'] = _local.connect
+        record['error'] = type(e).__name__
+        _emit(tracer, record)
+        raise
+    record['total'] = time.time() - t0
+    record['connect'] = _local.connect
+    record['status'] = res.status_code
+    record['ttfb'] = res.elapsed.total_seconds()
+    length = res.request.headers.get('Content-Length')
+    record['sent'] = int(length) if length else None
+    if kwargs.get('stream'):
+        length = res.headers.get('Content-Length')
+        record['received'] = int(length) if length else None
+    else:
+        record['received'] = len(res.content)
+    _emit(tracer, record)
+    return res
+
+
+def _emit(tracer, record):
+    # A broken tracer must not break the transfer it is watching
+    try:
+        tracer(record)
+    except Exception as e:
+        logging.warn("Tracer failed on {0} {1}: {2}".format(record['method'],
+                                                            record['url'], e))
+
+
+class JSONLSink(object):
+    """Append each record as a line of JSON to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fp = open(path, 'a', 1)
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.fp.write(line)
+
+    def close(self):
+        self.fp.close()
+
+
+class RingBuffer(object):
+    """Keep the ``size`` most recent records in memory."""
+
+    def __init__(self, size=1000):
+        self.records = deque(maxlen=size)
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def __iter__(self):
+        return iter(list(self.records))
+
+    def __len__(self):
+        return len(self.records)
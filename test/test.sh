@@ -12,6 +12,104 @@ TEST=${YELLOW}
 NC='\033[0m'
 
 
+echo "${TEST}"
+echo "------------------"
+echo "-- Test Startup --"
+echo "------------------"
+echo "${NC}"
+# Loading the entry point must not import requests, sqlite3, the client or
+# the mput/mget packages, those are left to the commands that use them.  The
+# time it takes (best of 5 cold starts) is only checked against
+# STARTUP_BUDGET seconds as a warning, it depends on the machine and its load
+STARTUP_BUDGET=${STARTUP_BUDGET:-0.05}
+python - ${STARTUP_BUDGET} <<'END' || exit 1
+import subprocess
+import sys
+
+PROBE = """
+import sys, time
+t0 = time.time()
+import cli.drastic
+t1 = time.time()
+heavy = [m for m in ('requests', 'sqlite3', 'cli.client', 'cli.mput', 'cli.mget')
+         if m in sys.modules]
+print('%f %s' % (t1 - t0, ','.join(heavy)))
+"""
+budget = float(sys.argv[1])
+runs = [subprocess.check_output([sys.executable, '-c', PROBE]).split()
+        for _ in range(5)]
+best = min(float(run[0]) for run in runs)
+heavy = runs[0][1] if len(runs[0]) > 1 else ''
+print('import cli.drastic: %.1f ms (budget %.1f ms)' % (best * 1000, budget * 1000))
+if heavy:
+    print('FAILED - imported at startup: %s' % heavy)
+    sys.exit(1)
+if best > budget:
+    print('WARNING - startup over budget')
+END
+echo
+
+echo "${TEST}"
+echo "-------------------------"
+echo "-- Test Listing Parser --"
+echo "-------------------------"
+echo "${NC}"
+# iter_children reads the names of a container listing as its bytes arrive,
+# each body is fed whole, cut at every offset and one byte at a time
+python - <<'END' || exit 1
+# -*- coding: utf-8 -*-
+import json
+import sys
+from cli.client import iter_children
+
+CASES = [
+    {"objectName": "c/", "children": ["a", "b/", "c d"], "childrenrange": "0-2"},
+    {"children": []},
+    {"objectName": "c/"},
+    # Escapes, and characters of several bytes in utf-8
+    {"children": [u'q"uote', u'back\\slash', u'tab\tnew\nline', u'été',
+                  u'\U0001f600', u'日本', u'\\"', u'']},
+    # "children" nested in the metadata, and brackets inside strings
+    {"metadata": {"children": ["x"], "deep": [{"children": ["y"]}, [1, [2]]],
+                  "s": ']}"children": ["z"]'},
+     "children": ["real", "]", "}"], "completionStatus": "Complete"},
+    # "children" as a value, not as the key
+    {"objectName": "children", "parentURI": "/children/", "tags": ["children"],
+     "children": ["children", "children/"], "n": 1.5e3, "t": True, "z": None},
+    # The children before the rest of the object
+    {"children": ["first"], "metadata": {"children": ["no"]}, "objectName": "c/"},
+]
+
+
+def check(body, expected):
+    chunkings = [[body], [body[i:i + 1] for i in range(len(body))]]
+    chunkings += [[body[:i], body[i:]] for i in range(1, len(body))]
+    for chunks in chunkings:
+        got = list(iter_children(chunks))
+        if got != expected:
+            print('FAILED - %r cut as %r: %r' % (body, chunks, got))
+            return False
+    return True
+
+
+ok = True
+for case in CASES:
+    for ascii in (True, False):
+        body = json.dumps(case, ensure_ascii=ascii)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        ok = check(body, case.get('children', [])) and ok
+try:
+    list(iter_children(['{"children": ["a", "b']))
+    print('FAILED - a listing cut in a string is accepted')
+    ok = False
+except ValueError:
+    pass
+print('%d listings parsed' % (len(CASES) * 2))
+sys.exit(0 if ok else 1)
+END
+echo
+
 echo "${TEST}"
 echo "---------------------"
 echo "-- Test Connection --"
@@ -48,6 +146,28 @@ echo "${NC}"
 indigo whoami
 echo
 
+echo "${TEST}"
+echo "-----------------------"
+echo "-- Test Session Info --"
+echo "-----------------------"
+echo "${NC}"
+# pwd and whoami are answered from session.json, without unpickling the
+# client of the session
+SESSION_DIR=~/.drastic
+PWD_BEFORE=$(indigo pwd)
+WHOAMI_BEFORE=$(indigo whoami)
+mv ${SESSION_DIR}/session.pickle ${SESSION_DIR}/session.pickle.saved
+PWD_AFTER=$(indigo pwd) && WHOAMI_AFTER=$(indigo whoami)
+STATUS=$?
+mv ${SESSION_DIR}/session.pickle.saved ${SESSION_DIR}/session.pickle
+echo "${PWD_AFTER}"
+echo "${WHOAMI_AFTER}"
+if [ ${STATUS} -ne 0 ] || [ "${PWD_AFTER}" != "${PWD_BEFORE}" ] || [ "${WHOAMI_AFTER}" != "${WHOAMI_BEFORE}" ]
+then
+    echo "${MSG}FAILED - pwd and whoami need session.pickle${NC}"
+fi
+echo
+
 echo "${TEST}"
 echo "-----------------------------"
 echo "-- Test Collection Actions --"